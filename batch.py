@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import json
+import traceback
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+import tilegen
+import map as map_tool
+
+
+def load_manifest(filename):
+    if os.path.splitext(filename)[1].lower() == '.toml':
+        if tomllib is None:
+            sys.exit('TOML manifests require Python 3.11 or newer')
+        with open(filename, 'rb') as fd:
+            return tomllib.load(fd)
+    with open(filename, 'rt') as fd:
+        return json.load(fd)
+
+
+# run a job with the same arguments its script takes on the command line
+def run_job(job):
+    tool = job.get('tool')
+    args = [str(arg) for arg in job.get('args', [])]
+    if tool == 'tilegen':
+        files, tile_size, output_dir, tileset_size, options = tilegen.parse_args(['tilegen.py'] + args)
+        tilegen.tilegen(files, tile_size, output_dir, tileset_size, **options)
+    elif tool == 'map':
+        parser = map_tool.make_parser()
+        parser.prog = 'map.py'
+        parsed = parser.parse_args(args)
+        if output := job.get('output'):
+            # a failed job shouldn't leave an empty output behind
+            map_tool.remove_list.append(output)
+            with open(output, 'wt') as fd:
+                map_tool.convert(parsed, fd=fd)
+        else:
+            map_tool.convert(parsed)
+    else:
+        sys.exit(f'Unknown tool {tool!r}, tilegen or map expected')
+
+
+# remove the files of the failed job
+def remove_outputs():
+    for filename in map_tool.remove_list:
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+
+def main():
+    if len(sys.argv) != 2 or '--help' in sys.argv:
+        sys.exit(f'usage: {sys.argv[0]} manifest.json|manifest.toml')
+
+    manifest = load_manifest(sys.argv[1])
+    # images and configurations are loaded once for all jobs
+    tilegen.shared_tiles = {}
+
+    for index, job in enumerate(manifest.get('jobs', [])):
+        tilegen.debug(f'job {index}: {job.get("tool")} {job.get("args")}')
+        del map_tool.remove_list[:]
+        try:
+            run_job(job)
+        except (tilegen.TilegenError, map_tool.MapError) as ex:
+            print(f'ERROR: job {index} ({job.get("tool")}): {ex}', file=sys.stderr)
+            remove_outputs()
+            sys.exit(1)
+        except Exception as ex:
+            print(f'FATAL: job {index} ({job.get("tool")}): {ex}\n***', file=sys.stderr)
+            traceback.print_exc()
+            remove_outputs()
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,30 @@
 #!/usr/bin/env python3
 
-from argparse import ArgumentParser
-from collections import defaultdict
+from argparse import ArgumentParser, ArgumentTypeError
+from array import array
+from bisect import bisect_right
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from os import path
+import base64
+import gzip
+import hashlib
 import json
+import mmap
 import os
+import shutil
 import subprocess
 import struct
 import sys
 import tempfile
 import traceback
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 __version__ = "1.0"
 
@@ -19,17 +34,54 @@ DEF_BITS = 8
 
 DEF_MAP_CONF = "map_conf.json"
 
+# aPLib compressor command
+APULTRA = os.getenv("APULTRA", "apultra")
+
+# Tiled stores flip flags in the upper 3 bits of the gid
+GID_MASK = 0x1FFFFFFF
+
 """
 Format:
 
            2 bytes: map data length (0 for empty map; no more data included)
             1 byte: entities length (1 is just the terminator 0xff)
-  map length bytes: map data (n-bit per tile) H x W x n (may be compressed)
+            1 byte: codec id, only with --compress (see CODECS)
+  map length bytes: map data (n-bit per tile) H x W x n, followed with
+                    --flips by the flip flags of every tile, 4 bits per tile
+                    (H = 4, V = 2, D = 1) in the same order (may be
+                    compressed)
            i bytes: entity data (0xff for end)
 
+RLE codec, tokens followed by their data:
+
+    0x00-0x7f: n + 1 literal bytes follow
+    0x80-0xff: repeat next byte (n & 0x7f) + 2 times
+
+LZ codec, tokens followed by their data:
+
+    0x00-0x7f: n + 1 literal bytes follow
+    0x80-0xff: copy (n & 0x7f) + 3 bytes from offset + 1 bytes back, the
+               offset is the next byte
+
+Archive format (--archive), little-endian:
+
+           4 bytes: magic "TMAP"
+            1 byte: version (1)
+            1 byte: flags (bit 0: compressed, bit 1: rooms have a codec id)
+           2 bytes: number of rooms (n)
+           2 bytes: rooms per row (WMAPS)
+       n x 8 bytes: room offset and length (4 bytes each; 0, 0 for empty
+                    rooms, identical rooms may share an offset)
+       blob bytes: rooms in the format above, one after another
+
 Expected layers: Map and Entities
 """
 
+ARCHIVE_MAGIC = b"TMAP"
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = struct.Struct("<4sBBHH")
+ARCHIVE_ENTRY = struct.Struct("<II")
+
 
 def apultra_compress(data):
     with tempfile.NamedTemporaryFile() as fd:
@@ -37,7 +89,7 @@ def apultra_compress(data):
         fd.flush()
 
         ap_name = fd.name + ".ap"
-        subprocess.call(["apultra", "-v", fd.name, ap_name], stdout=sys.stderr)
+        subprocess.call([APULTRA, "-v", fd.name, ap_name], stdout=sys.stderr)
 
     with open(ap_name, "rb") as fd:
         out = fd.read()
@@ -46,6 +98,263 @@ def apultra_compress(data):
     return [int(byte) for byte in out]
 
 
+# compressor banner, so cached rooms are compressed again after upgrading it
+@lru_cache(maxsize=None)
+def apultra_version():
+    try:
+        result = subprocess.run([APULTRA], capture_output=True)
+    except OSError as ex:
+        raise MapError("can't run %s: %s" % (APULTRA, ex))
+    return (result.stdout + result.stderr).split(b"\n")[0]
+
+
+# compress non-empty rooms with jobs concurrent compressor processes;
+# compressed rooms are kept in cache_dir keyed by their contents and the
+# compressor version
+def compress_rooms(out, empty, jobs=1, cache_dir=None):
+    def compress(block):
+        if cache_dir:
+            key = hashlib.sha256(apultra_version() + b"\0" + bytes(block)).hexdigest()
+            filename = path.join(cache_dir, key + ".ap")
+            if path.exists(filename):
+                with open(filename, "rb") as fd:
+                    return list(fd.read())
+
+        compressed = apultra_compress(block)
+        if cache_dir:
+            # write to a temporary file first, other jobs may read the same entry
+            tmp = "%s.%d.%d.tmp" % (filename, os.getpid(), id(block))
+            with open(tmp, "wb") as fd:
+                fd.write(bytes(compressed))
+            os.replace(tmp, filename)
+        return compressed
+
+    if cache_dir and not path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    empty = set(empty)
+    todo = [block for i, block in enumerate(out) if i not in empty]
+    with ThreadPoolExecutor(jobs) as pool:
+        results = pool.map(compress, todo)
+        return [None if i in empty else next(results) for i in range(len(out))]
+
+
+# room codecs: id stored in the room header, compress(data) returning the
+# compressed bytes as a list and cost(compressed, size) estimating the Z80
+# T-states needed to decompress it. Optionally, bulk(out, empty, args)
+# compresses every room at once (None for empty rooms) instead of calling
+# compress for each one, and available() tells if the codec can be used,
+# auto skips it otherwise
+Codec = namedtuple("Codec", "id compress cost bulk available", defaults=(None, None))
+CODECS = {}
+
+
+def register_codec(name, codec_id, compress, cost, bulk=None, available=None):
+    if any(codec.id == codec_id for codec in CODECS.values()):
+        raise ValueError("codec id %d already registered" % codec_id)
+    CODECS[name] = Codec(codec_id, compress, cost, bulk, available)
+
+
+# rough Z80 costs in T-states: reading a token and setting up the copy
+# (longer for matches, which read an offset), and every byte copied with
+# LDIR; runs are filled by copying from the previous byte
+TOKEN_CYCLES = 45
+MATCH_CYCLES = 70
+COPY_CYCLES = 21
+# average for aPLib decompressors, which decode bit by bit
+APLIB_CYCLES = 60
+
+
+def raw_cost(data, size):
+    return TOKEN_CYCLES + COPY_CYCLES * size
+
+
+def aplib_cost(data, size):
+    return APLIB_CYCLES * size
+
+
+def literal_tokens(literals):
+    out = []
+    for i in range(0, len(literals), 128):
+        part = literals[i : i + 128]
+        out.append(len(part) - 1)
+        out.extend(part)
+    return out
+
+
+def rle_compress(data):
+    out = []
+    literals = []
+    i = 0
+    while i < len(data):
+        run = 1
+        while run < 129 and i + run < len(data) and data[i + run] == data[i]:
+            run += 1
+        if run < 3:
+            literals.append(data[i])
+            i += 1
+            continue
+        out.extend(literal_tokens(literals))
+        literals = []
+        out.extend([0x80 | (run - 2), data[i]])
+        i += run
+    return out + literal_tokens(literals)
+
+
+# (literal bytes, None) or (repeated byte, count) for every RLE token
+def rle_tokens(data):
+    i = 0
+    while i < len(data):
+        token = data[i]
+        if token < 0x80:
+            yield data[i + 1 : i + token + 2], None
+            i += token + 2
+        else:
+            yield data[i + 1], (token & 0x7F) + 2
+            i += 2
+
+
+def rle_decompress(data):
+    out = bytearray()
+    for value, count in rle_tokens(data):
+        out.extend(bytes(value) if count is None else bytes([value]) * count)
+    return out
+
+
+def rle_cost(data, size):
+    cycles = 0
+    for value, count in rle_tokens(data):
+        if count is None:
+            cycles += TOKEN_CYCLES + COPY_CYCLES * len(value)
+        else:
+            cycles += TOKEN_CYCLES + COPY_CYCLES * count
+    return cycles
+
+
+# greedy LZ77 with a 256 byte window; candidates are found through chains
+# of positions indexed by their first 3 bytes
+def lz_compress(data):
+    data = bytes(data)
+    chains = defaultdict(list)
+    out = []
+    literals = []
+    i = 0
+    while i < len(data):
+        best, offset = 0, 0
+        for j in reversed(chains.get(data[i : i + 3], ())):
+            if i - j > 256:
+                break
+            length = 0
+            while length < 130 and i + length < len(data) and data[j + length] == data[i + length]:
+                length += 1
+            if length > best:
+                best, offset = length, i - j
+                if length == 130:
+                    break
+        if best < 3:
+            chains[data[i : i + 3]].append(i)
+            literals.append(data[i])
+            i += 1
+            continue
+        out.extend(literal_tokens(literals))
+        literals = []
+        out.extend([0x80 | (best - 3), offset - 1])
+        for k in range(i, i + best):
+            chains[data[k : k + 3]].append(k)
+        i += best
+    return out + literal_tokens(literals)
+
+
+# (literal bytes, None) or (offset, length) for every LZ token
+def lz_tokens(data):
+    i = 0
+    while i < len(data):
+        token = data[i]
+        if token < 0x80:
+            yield data[i + 1 : i + token + 2], None
+            i += token + 2
+        else:
+            yield data[i + 1] + 1, (token & 0x7F) + 3
+            i += 2
+
+
+def lz_decompress(data):
+    out = bytearray()
+    for value, length in lz_tokens(data):
+        if length is None:
+            out.extend(bytes(value))
+        else:
+            # byte by byte, matches may overlap the bytes they produce
+            for _ in range(length):
+                out.append(out[-value])
+    return out
+
+
+def lz_cost(data, size):
+    cycles = 0
+    for value, length in lz_tokens(data):
+        if length is None:
+            cycles += TOKEN_CYCLES + COPY_CYCLES * len(value)
+        else:
+            cycles += MATCH_CYCLES + COPY_CYCLES * length
+    return cycles
+
+
+register_codec("none", 0, list, raw_cost)
+register_codec(
+    "aplib",
+    1,
+    apultra_compress,
+    aplib_cost,
+    bulk=lambda out, empty, args: compress_rooms(out, empty, args.jobs, args.cache),
+    available=lambda: shutil.which(APULTRA) is not None,
+)
+register_codec("rle", 2, rle_compress, rle_cost)
+register_codec("lz", 3, lz_compress, lz_cost)
+
+
+# compress non-empty rooms with the given codec, or with every codec if
+# "auto", returning the rooms and the codec id of each one. Auto picks the
+# fastest codec to decode among those within budget percent of the
+# smallest output
+def compress_codecs(out, empty, name, args, budget=0):
+    names = list(CODECS) if name == "auto" else [name]
+    if name == "auto":
+        for codec in list(names):
+            if CODECS[codec].available is not None and not CODECS[codec].available():
+                names.remove(codec)
+                if not args.quiet:
+                    warning("%s codec not available, skipped" % codec)
+
+    empty = set(empty)
+    candidates = {}
+    for codec in names:
+        if CODECS[codec].bulk is not None:
+            candidates[codec] = CODECS[codec].bulk(out, empty, args)
+        else:
+            candidates[codec] = [
+                None if i in empty else CODECS[codec].compress(block)
+                for i, block in enumerate(out)
+            ]
+
+    rooms = []
+    ids = []
+    for i, block in enumerate(out):
+        if i in empty:
+            rooms.append(None)
+            ids.append(None)
+            continue
+        options = [
+            (len(candidates[codec][i]), CODECS[codec].cost(candidates[codec][i], len(block)), codec)
+            for codec in names
+        ]
+        limit = min(options)[0] * (100 + budget) / 100
+        _, _, codec = min((o for o in options if o[0] <= limit), key=lambda o: (o[1], o[0]))
+        rooms.append(candidates[codec][i])
+        ids.append(CODECS[codec].id)
+    return rooms, ids
+
+
 def find_name(data, name):
     for item in data:
         if item.get("name").lower() == name.lower():
@@ -60,6 +369,61 @@ def find_id(data, id):
     raise ValueError("id %r not found", id)
 
 
+# gids as a compact array from a list or Tiled's base64 encoding, which
+# may be compressed
+def decode_data(data, layer):
+    if layer.get("encoding") != "base64":
+        return array("I", data)
+
+    data = base64.b64decode(data)
+    compression = layer.get("compression", "")
+    if compression == "zlib":
+        data = zlib.decompress(data)
+    elif compression == "gzip":
+        data = gzip.decompress(data)
+    elif compression:
+        raise ValueError("unsupported layer compression %r" % compression)
+
+    # little-endian 32-bit gids
+    data = array("I", data)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data
+
+
+# gids of a tile layer in row-major order; chunks of infinite maps are
+# copied into place one by one, relative to the layer origin
+def layer_data(layer):
+    if "chunks" not in layer:
+        return decode_data(layer["data"], layer)
+
+    width = layer["width"]
+    startx = layer.get("startx", 0)
+    starty = layer.get("starty", 0)
+    data = array("I", bytes(4 * width * layer["height"]))
+    for chunk in layer["chunks"]:
+        chunk_data = decode_data(chunk["data"], layer)
+        cw = chunk["width"]
+        for j in range(chunk["height"]):
+            start = (chunk["y"] - starty + j) * width + chunk["x"] - startx
+            data[start : start + cw] = chunk_data[j * cw : (j + 1) * cw]
+    return data
+
+
+# map size and origin in tiles; infinite maps cover the area of the chunks
+# of the "Map" layer
+def map_area(data):
+    if data.get("infinite"):
+        layer = find_name(data["layers"], "Map")
+        return (
+            layer["width"],
+            layer["height"],
+            layer.get("startx", 0),
+            layer.get("starty", 0),
+        )
+    return data.get("width", 0), data.get("height", 0), 0, 0
+
+
 def get_property(obj, name, default):
     props = obj.get("properties", {})
 
@@ -73,8 +437,19 @@ def get_property(obj, name, default):
     return default
 
 
-def main():
+class MapError(ValueError):
+    pass
+
+
+def metatile_size(value):
+    try:
+        width, height = (int(n) for n in value.lower().split("x"))
+    except ValueError:
+        raise ArgumentTypeError("WxH expected, like 2x2")
+    return width, height
+
 
+def make_parser():
     parser = ArgumentParser(
         description="Map importer",
         epilog="Copyright (C) 2020 Juan J Martinez <jjm@usebox.net>," +
@@ -118,12 +493,27 @@ def main():
         action="store_true",
         help="output binary data (default: C code)",
     )
+    parser.add_argument(
+        "--archive",
+        dest="archive",
+        action="store_true",
+        help="output a single binary archive with a room index",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="format",
+        default="c",
+        choices=("c", "asm", "incbin"),
+        help="source output: C, assembly (db) or assembly including"
+        " the bin files (default: c)",
+    )
     parser.add_argument(
         "-d",
         dest="dir",
         default=".",
         type=str,
-        help="directory to generate the bin files (default: .)",
+        help="directory to generate the bin files or archive (default: .)",
     )
     parser.add_argument(
         "-c",
@@ -132,9 +522,67 @@ def main():
         type=str,
         help="JSON configuration file (default: %s)" % DEF_MAP_CONF,
     )
+    parser.add_argument(
+        "--bits",
+        dest="bits",
+        default=DEF_BITS,
+        type=int,
+        choices=(1, 2, 4, 8),
+        help="bits per tile (default: %s)" % DEF_BITS,
+    )
     parser.add_argument(
         "--aplib", dest="aplib", action="store_true", help="APLIB compressed"
     )
+    parser.add_argument(
+        "--flips",
+        dest="flips",
+        action="store_true",
+        help="store Tiled flip flags of every tile after the room tiles",
+    )
+    parser.add_argument(
+        "--metatiles",
+        dest="metatiles",
+        default=None,
+        type=metatile_size,
+        metavar="WxH",
+        help="encode rooms as indexes to a table of WxH tile blocks",
+    )
+    parser.add_argument(
+        "--compress",
+        dest="compress",
+        default=None,
+        choices=tuple(CODECS) + ("auto",),
+        help="compress rooms with a codec, storing its id in the room header;"
+        " auto picks the best one per room",
+    )
+    parser.add_argument(
+        "--budget",
+        dest="budget",
+        default=0,
+        type=int,
+        help="with --compress auto, pick the fastest codec to decode within"
+        " this percentage of the smallest size (default: 0)",
+    )
+    parser.add_argument(
+        "--jobs",
+        dest="jobs",
+        default=1,
+        type=int,
+        help="number of concurrent compressions (default: 1)",
+    )
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        default=None,
+        type=str,
+        help="directory to keep compressed rooms between runs",
+    )
+    parser.add_argument(
+        "--dedup",
+        dest="dedup",
+        action="store_true",
+        help="store identical rooms only once",
+    )
     parser.add_argument(
         "-r", dest="reverse", action="store_true", help="Reverse map order"
     )
@@ -146,59 +594,553 @@ def main():
     )
     parser.add_argument("map_json", help="Map to import")
     parser.add_argument("id", help="variable name")
+    return parser
 
-    args = parser.parse_args()
 
-    with open(args.map_json, "rt") as fd:
-        data = json.load(fd)
+# configurations are shared by all maps converted in the same process
+conf_cache = {}
 
-    mh = data.get("height", 0)
-    mw = data.get("width", 0)
 
-    if mh < args.rh or mh % args.rh:
-        parser.error("Map size height not multiple of the room size (%i)" % args.rh)
-    if mw < args.rw or mw % args.rw:
-        parser.error("Map size width not multiple of the room size (%i)" % args.rw)
+def load_conf(filename):
+    key = (path.abspath(filename), path.getmtime(filename))
+    if key not in conf_cache:
+        with open(filename, "rt") as fd:
+            conf_cache[key] = json.load(fd)
+    return conf_cache[key]
+
+
+def warning(message):
+    print("%s: warning: %s" % (path.basename(sys.argv[0]), message), file=sys.stderr)
 
-    tilewidth = data["tilewidth"]
-    tileheight = data["tileheight"]
 
-    tile_layer = find_name(data["layers"], "Map")["data"]
+# tile indexes of the "Map" layer, relative to their tileset (-1 if empty),
+# and their Tiled flip flags (H = 4, V = 2, D = 1) or None if no tile is
+# flipped; as NumPy arrays if available or compact arrays otherwise
+def read_tiles(data):
+    tile_layer = layer_data(find_name(data["layers"], "Map"))
+    flags = None
 
     def_tileset = find_name(data["tilesets"], "default")
     firstgid = def_tileset.get("firstgid")
 
-    out = []
-    for y in range(0, mh, args.rh):
-        for x in range(0, mw, args.rw):
-            block = []
-            if args.transpose:
-                for i in range(args.rw):
-                    for j in range(args.rh):
-                        block.append(tile_layer[x + i + (y + j) * mw] - firstgid)
-                        print('x', block)
+    # indexes of tiles in bank tilesets (written by tilegen.py --banks) are
+    # relative to their bank, other tiles are relative to the default tileset
+    tilesets = sorted(data["tilesets"], key=lambda ts: ts.get("firstgid"))
+    firstgids = [ts.get("firstgid") for ts in tilesets]
+    bases = [
+        ts.get("firstgid") if get_property(ts, "bank", None) is not None else firstgid
+        for ts in tilesets
+    ]
+    banked = any(base != firstgid for base in bases)
+
+    if np is not None:
+        tile_layer = np.frombuffer(tile_layer, dtype=np.uint32)
+        if (tile_layer > GID_MASK).any():
+            flags = (tile_layer >> 29).astype(np.int64)
+            tile_layer = tile_layer & GID_MASK
+        tile_layer = tile_layer.astype(np.int64)
+        if banked:
+            starts = np.asarray(bases)[
+                np.maximum(np.searchsorted(firstgids, tile_layer, "right") - 1, 0)
+            ]
+            tile_layer = np.where(tile_layer != 0, tile_layer - starts + firstgid, 0)
+        return tile_layer - firstgid, flags
+
+    if any(gid & ~GID_MASK for gid in tile_layer):
+        flags = array("l", (gid >> 29 for gid in tile_layer))
+        tile_layer = [gid & GID_MASK for gid in tile_layer]
+
+    if banked:
+        tile_layer = [
+            gid - bases[max(bisect_right(firstgids, gid) - 1, 0)] + firstgid
+            if gid else 0
+            for gid in tile_layer
+        ]
+    return array("l", (gid - firstgid for gid in tile_layer)), flags
+
+
+# split the tile layer in rooms, in row-major room order; tiles of every
+# room are stored by rows, or by columns if transposed
+def cut_rooms(tile_layer, mw, mh, rw, rh, transpose=False):
+    if np is not None:
+        rooms = np.asarray(tile_layer).reshape(mh // rh, rh, mw // rw, rw).swapaxes(1, 2)
+        if transpose:
+            rooms = rooms.swapaxes(2, 3)
+        return rooms.reshape(-1, rw * rh)
+
+    rows = [tile_layer[y * mw:(y + 1) * mw] for y in range(mh)]
+    rooms = []
+    for y in range(0, mh, rh):
+        for x in range(0, mw, rw):
+            block = [row[x:x + rw] for row in rows[y:y + rh]]
+            if transpose:
+                block = zip(*block)
+            rooms.append([tile for line in block for tile in line])
+    return rooms
+
+
+# replace every bw x bh block of tiles by its index in a table of unique
+# blocks (metatiles), most used first; the empty block is -1 and isn't
+# stored. Returns the layer of metatile indexes and the table, with the
+# tiles of every metatile by rows, or by columns if transposed
+def find_metatiles(tile_layer, mw, mh, bw, bh, transpose=False):
+    blocks = cut_rooms(tile_layer, mw, mh, bw, bh, transpose)
+    if np is not None:
+        blocks = blocks.tolist()
+    blocks = [tuple(block) for block in blocks]
+
+    empty = (-1,) * (bw * bh)
+    table = [block for block, _ in Counter(blocks).most_common() if block != empty]
+    index = dict((block, i) for i, block in enumerate(table))
+    index[empty] = -1
+    return [index[block] for block in blocks], table
+
+
+# pack 8 // bits tiles per byte, the first tile in the most significant bits
+def pack_room(block, bits=DEF_BITS):
+    mask = (1 << bits) - 1
+    current = []
+    for i in range(0, len(block), 8 // bits):
+        b = 0
+        for tile in block[i:i + 8 // bits]:
+            b = (b << bits) | (tile & mask)
+        current.append(b)
+    return current
+
+
+# pack all rooms at once, returning a list of bytes (as ints) per room
+def pack_rooms(rooms, bits=DEF_BITS):
+    if np is None:
+        return [pack_room(block, bits) for block in rooms]
+
+    tiles = np.asarray(rooms, dtype=np.int64).reshape(len(rooms), -1, 8 // bits)
+    shifts = np.arange(8 - bits, -1, -bits)
+    return ((tiles & ((1 << bits) - 1)) << shifts).sum(axis=2).tolist()
+
+
+def add_entities(out, data, args, mw):
+    tilewidth = data["tilewidth"]
+    tileheight = data["tileheight"]
+    # object coordinates of infinite maps are relative to the map origin
+    _, _, startx, starty = map_area(data)
+
+    try:
+        entities_layer = find_name(data["layers"], "Entities")
+    except ValueError:
+        entities_layer = []
+        if not args.quiet:
+            warning("'Entities' layer not found")
+    if not len(entities_layer) or not entities_layer["visible"]:
+        return
+
+    conf = load_conf(args.conf)
+    # first entry wins for repeated names, like a list lookup would
+    et_ids = {}
+    for i, d in enumerate(conf["entities"]):
+        et_ids.setdefault(d["name"], i)
+    et_weigths = dict((d["name"], d["w"]) for d in conf["entities"])
+    et_bytes = dict((d["name"], d["bytes"]) for d in conf["entities"])
+    map_ents = defaultdict(list)
+    map_ents_w = defaultdict(int)
+    map_ents_bytes = defaultdict(int)
+    map_ents_names = set()
+
+    def check_bytes(name):
+        if name not in map_ents_names:
+            # update the entity size in bytes count per map
+            try:
+                map_ents_bytes[m] += et_bytes[name]
+                map_ents_names.add(name)
+            except KeyError:
+                raise MapError("max_bytes: no 'bytes' found for %r" % name)
+
+    # objects sorted by entity type, then x and y, each one with its type
+    try:
+        objs = sorted(
+            ((et_ids[obj["name"].lower()], obj) for obj in entities_layer["objects"]),
+            key=lambda item: (item[0], item[1]["x"], item[1]["y"]),
+        )
+    except KeyError:
+        raise MapError("map has an unnamed object")
+
+    for t, obj in objs:
+        name = obj["name"].lower()
+        obj_x = obj["x"] - startx * tilewidth
+        obj_y = obj["y"] - starty * tileheight
+        m = ((obj_x // tilewidth) // args.rw) + (
+            ((obj_y // tileheight) // args.rh) * (mw // args.rw)
+        )
+        x = obj_x % (args.rw * tilewidth)
+        y = obj_y % (args.rh * tileheight)
+
+        # MSB is direction
+
+        param = int(get_property(obj, "param", 0))
+        if param == 1:
+            t |= 128
+
+        if args.max_ents:
+            # update the entity count per map
+            try:
+                map_ents_w[m] += et_weigths[name]
+            except KeyError:
+                raise MapError("max_ents: no 'w' found for %r" % name)
+
+        if args.max_bytes:
+            check_bytes(name)
+
+        special = None
+
+        # specials
+        if get_property(obj, "fixed", None) is not None:
+            if obj["width"] >= obj["height"]:
+                special = obj["width"] - tilewidth
+                if not param:
+                    x += special
+                special //= tilewidth
+                # flag horizonal
+                special |= 128
             else:
-                for j in range(args.rh):
-                    for i in range(args.rw):
-                        block.append(tile_layer[x + i + (y + j) * mw] - firstgid)
-                        sys.exit()
+                special = obj["height"] - tileheight
+                if not param:
+                    y += special
+                special //= tileheight
+
+        map_ents[m].extend([t, x, y])
+        if special is not None:
+            if isinstance(special, (tuple, list)):
+                map_ents[m].extend(special)
+            else:
+                map_ents[m].append(special)
+
+    if args.max_ents:
+        for i, weight in map_ents_w.items():
+            if weight > args.max_ents:
+                raise MapError(
+                    "map %i has %d entities, max is %d" % (i, weight, args.max_ents)
+                )
+
+    if args.max_bytes:
+        for i, byts in map_ents_bytes.items():
+            if byts > args.max_bytes:
+                raise MapError(
+                    "map %i entities are %d bytes, max is %d"
+                    % (i, byts, args.max_bytes)
+                )
+
+    # append the entities to the map data
+    for i in range(len(out)):
+        if not out[i]:
+            continue
+        elif map_ents[i]:
+            out[i].extend(map_ents[i])
+            out[i][2] += len(map_ents[i])
+        # terminator
+        out[i].append(0xFF)
+        out[i][2] += 1
+
+
+# map every room identical to a previous one to the index of that room;
+# empty rooms aren't stored, so they aren't shared
+def find_duplicates(out, empty):
+    first = {}
+    duplicates = {}
+    for i, block in enumerate(out):
+        if block is None or i in empty:
+            continue
+        j = first.setdefault(bytes(block), i)
+        if j != i:
+            duplicates[i] = j
+    return duplicates
+
+
+def print_stats(out, empty, args, duplicates=None):
+    screen_with_data = len(out) - len(empty)
+    total_bytes = sum(len(b) if b else 0 for b in out)
+    saved = ""
+    if duplicates is not None:
+        saved_bytes = sum(len(out[i]) for i in duplicates)
+        total_bytes -= saved_bytes
+        saved = ", %d shared, %d bytes saved" % (len(duplicates), saved_bytes)
+    print(
+        "%s: %s (%d screens, %d bytes, %.2f bytes avg%s)"
+        % (
+            path.basename(sys.argv[0]),
+            args.id,
+            screen_with_data,
+            total_bytes,
+            total_bytes / screen_with_data,
+            saved,
+        ),
+        file=sys.stderr,
+    )
 
-            # pack
-            current = []
-            for i in range(0, args.rh * args.rw, 8 // DEF_BITS):
-                tiles = []
-                for k in range(8 // DEF_BITS):
-                    tiles.append(block[i + k])
 
-                b = 0
-                pos = 8
-                for k in range(8 // DEF_BITS):
-                    pos -= DEF_BITS
-                    b |= (tiles[k] & ((2**DEF_BITS) - 1)) << pos
+# duplicated rooms are hard links to the file of the first identical room
+def write_bin(out, empty, args, duplicates=None):
+    duplicates = duplicates or {}
+    for i, block in enumerate(out):
+        filename = path.join(args.dir, "%s%02d.bin" % (args.id, i))
+        remove_list.append(filename)
+        if i in duplicates:
+            first = path.join(args.dir, "%s%02d.bin" % (args.id, duplicates[i]))
+            if path.lexists(filename):
+                os.unlink(filename)
+            try:
+                os.link(first, filename)
+            except OSError:
+                shutil.copyfile(first, filename)
+            continue
+        with open(filename, "wb") as fd:
+            if i in empty:
+                fd.write(struct.pack("<B", 0))
+            else:
+                fd.write(bytearray(block))
+
+
+def archive_flags(args):
+    return (1 if args.aplib or args.compress not in (None, "none") else 0) | (
+        2 if args.compress else 0
+    )
+
+
+# single binary with an index of fixed-width entries followed by the rooms
+def write_archive(out, empty, args, mw, duplicates=None):
+    duplicates = duplicates or {}
+    filename = path.join(args.dir, "%s.pak" % args.id)
+    remove_list.append(filename)
+    if len(out) > 0xFFFF:
+        raise MapError("archives can't hold more than 65535 rooms")
+
+    offset = ARCHIVE_HEADER.size + ARCHIVE_ENTRY.size * len(out)
+    entries = []
+    for i, block in enumerate(out):
+        if i in empty or block is None:
+            entries.append((0, 0))
+        elif i in duplicates:
+            entries.append(entries[duplicates[i]])
+        else:
+            entries.append((offset, len(block)))
+            offset += len(block)
+
+    with open(filename, "wb") as fd:
+        fd.write(
+            ARCHIVE_HEADER.pack(
+                ARCHIVE_MAGIC, ARCHIVE_VERSION, archive_flags(args), len(out), mw // args.rw
+            )
+        )
+        for entry in entries:
+            fd.write(ARCHIVE_ENTRY.pack(*entry))
+        for i, block in enumerate(out):
+            if entries[i][1] and i not in duplicates:
+                fd.write(bytearray(block))
+
+
+# random access to the rooms of an archive written with --archive
+class MapArchive:
+    def __init__(self, filename):
+        with open(filename, "rb") as fd:
+            self.data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, flags, self.rooms, self.wmaps = ARCHIVE_HEADER.unpack_from(
+                self.data
+            )
+        except struct.error:
+            magic = None
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            self.close()
+            raise MapError("%s is not a map archive" % filename)
+        self.compressed = bool(flags & 1)
+
+    def __len__(self):
+        return self.rooms
+
+    # room data as bytes, empty for empty rooms
+    def __getitem__(self, index):
+        if not 0 <= index < self.rooms:
+            raise IndexError("room index out of range")
+        offset, length = ARCHIVE_ENTRY.unpack_from(
+            self.data, ARCHIVE_HEADER.size + index * ARCHIVE_ENTRY.size
+        )
+        return self.data[offset : offset + length]
+
+    def __iter__(self):
+        return (self[i] for i in range(self.rooms))
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# room bytes in lines of width bytes, formatted with fmt
+def room_lines(block, width, fmt):
+    width = max(width, 1)
+    for part in range(0, len(block), width):
+        yield ", ".join(fmt % byte for byte in block[part : part + width])
 
-                current.append(b)
 
-            out.append(current)
+# metatile table, a byte per tile
+def write_metatiles(metatiles, args):
+    filename = path.join(args.dir, "%s_metatiles.bin" % args.id)
+    remove_list.append(filename)
+    with open(filename, "wb") as fd:
+        fd.write(bytes(metatiles))
+
+
+# rooms are written one by one as they come; duplicated rooms point to the
+# array of the first identical room
+def write_c(out, empty, args, mw, fd=None, duplicates=None, metatiles=None):
+    duplicates = duplicates or {}
+    fd = fd or sys.stdout
+    print("#ifndef _%s_H" % args.id.upper(), file=fd)
+    print("#define _%s_H" % args.id.upper(), file=fd)
+    print("/* compressed: %s */" % (args.compress or args.aplib), file=fd)
+    print("#define WMAPS %d\n" % (mw // args.rw), file=fd)
+    print("#define MAPS %d\n" % len(out), file=fd)
+    if metatiles is not None:
+        size = args.metatiles[0] * args.metatiles[1]
+        print("#define METATILE_W %d" % args.metatiles[0], file=fd)
+        print("#define METATILE_H %d" % args.metatiles[1], file=fd)
+        print("#define METATILES %d\n" % (len(metatiles) // size), file=fd)
+
+    print("#ifdef LOCAL", file=fd)
+
+    if metatiles is not None:
+        fd.write("const unsigned char %s_metatiles[%d] = {\n" % (args.id, len(metatiles)))
+        fd.write(",\n".join(room_lines(metatiles, size, "0x%02x")))
+        fd.write("\n};\n")
+
+    # includes a map table for fast access
+    for i, block in enumerate(out):
+        if not isinstance(block, list) or i in duplicates:
+            continue
+        fd.write("const unsigned char %s_%d[%d] = {\n" % (args.id, i, len(block)))
+        fd.write(",\n".join(room_lines(block, args.rw // 2, "0x%02x")))
+        fd.write("\n};\n")
+
+    fd.write("const unsigned char * const %s[%d] = { " % (args.id, len(out)))
+    fd.write(
+        ", ".join(
+            "%s_%d" % (args.id, duplicates.get(i, i)) if i not in empty else "(unsigned char *)0"
+            for i in range(len(out))
+        )
+    )
+    fd.write(" };\n\n")
+
+    print("#else", file=fd)
+    if metatiles is not None:
+        print("extern const unsigned char %s_metatiles[%d];" % (args.id, len(metatiles)), file=fd)
+    print("extern const unsigned char * const %s[%d];\n" % (args.id, len(out)), file=fd)
+
+    print("#endif // LOCAL", file=fd)
+    print("#endif // _%s_H" % args.id.upper(), file=fd)
+
+
+# sjasm/pasmo assembly: rooms as db lines written one by one, or as incbin
+# of the files written by write_bin()
+def write_asm(out, empty, args, mw, fd=None, duplicates=None, incbin=False, metatiles=None):
+    duplicates = duplicates or {}
+    fd = fd or sys.stdout
+    print("; %s, compressed: %s" % (args.id, args.compress or args.aplib), file=fd)
+    print("%s_WMAPS equ %d" % (args.id.upper(), mw // args.rw), file=fd)
+    print("%s_MAPS equ %d\n" % (args.id.upper(), len(out)), file=fd)
+
+    if metatiles is not None:
+        size = args.metatiles[0] * args.metatiles[1]
+        print("%s_METATILES equ %d\n" % (args.id.upper(), len(metatiles) // size), file=fd)
+        print("%s_metatiles:" % args.id, file=fd)
+        if incbin:
+            filename = path.join(args.dir, "%s_metatiles.bin" % args.id)
+            print('\tincbin "%s"' % filename, file=fd)
+        else:
+            for line in room_lines(metatiles, size, "$%02x"):
+                print("\tdb " + line, file=fd)
+
+    for i, block in enumerate(out):
+        if not isinstance(block, list) or i in duplicates:
+            continue
+        if incbin:
+            if i not in empty:
+                filename = path.join(args.dir, "%s%02d.bin" % (args.id, i))
+                print('%s_%d:\n\tincbin "%s"' % (args.id, i, filename), file=fd)
+            continue
+        print("%s_%d:" % (args.id, i), file=fd)
+        for line in room_lines(block, args.rw // 2, "$%02x"):
+            print("\tdb " + line, file=fd)
+
+    # map table for fast access
+    print("\n%s:" % args.id, file=fd)
+    for i in range(len(out)):
+        print("\tdw %s" % ("%s_%d" % (args.id, duplicates.get(i, i)) if i not in empty else "0"), file=fd)
+
+
+# convert a Tiled map (loaded from args.map_json if data is None), writing
+# C code to fd or binary files to args.dir
+def convert(args, data=None, fd=None):
+    if data is None:
+        with open(args.map_json, "rt") as map_fd:
+            data = json.load(map_fd)
+
+    mw, mh, _, _ = map_area(data)
+
+    if mh < args.rh or mh % args.rh:
+        raise MapError("Map size height not multiple of the room size (%i)" % args.rh)
+    if mw < args.rw or mw % args.rw:
+        raise MapError("Map size width not multiple of the room size (%i)" % args.rw)
+
+    if args.aplib and args.compress:
+        raise MapError("--aplib and --compress can't be used together")
+    if args.metatiles:
+        bw, bh = args.metatiles
+        if min(bw, bh) < 1 or args.rw % bw or args.rh % bh:
+            raise MapError("Room size not multiple of the metatile size (%ix%i)" % (bw, bh))
+        if ((args.rw // bw) * (args.rh // bh)) % (8 // args.bits):
+            raise MapError("Room size not multiple of %d metatiles per byte" % (8 // args.bits))
+    elif (args.rw * args.rh) % (8 // args.bits):
+        raise MapError("Room size not multiple of %d tiles per byte" % (8 // args.bits))
+    if args.flips:
+        if args.metatiles:
+            raise MapError("--flips can't be used with --metatiles")
+        if (args.rw * args.rh) % 2:
+            raise MapError("Room size should be even to store flip flags")
+    if args.jobs < 1:
+        raise MapError("Number of jobs should be greater than zero")
+    if args.budget < 0:
+        raise MapError("Budget should be zero or greater")
+
+    tile_layer, flags = read_tiles(data)
+    if flags is not None and not args.flips:
+        raise MapError("flipped tiles found, use --flips to keep their flags")
+    top = (tile_layer.max() if np is not None else max(tile_layer)) if len(tile_layer) else 0
+    metatiles = None
+    if args.metatiles:
+        # --bits applies to the metatile indexes, the table takes a byte per tile
+        if top >= 1 << 8:
+            raise MapError("tile indexes don't fit in the 8 bits of the metatile table")
+        bw, bh = args.metatiles
+        tile_layer, table = find_metatiles(tile_layer, mw, mh, bw, bh, args.transpose)
+        # all bits set is the empty metatile
+        if len(table) >= (1 << args.bits):
+            raise MapError(
+                "%d metatiles found, no more than %d fit in %d bits"
+                % (len(table), (1 << args.bits) - 1, args.bits)
+            )
+        metatiles = [tile & 0xFF for block in table for tile in block]
+        out = pack_rooms(
+            cut_rooms(tile_layer, mw // bw, mh // bh, args.rw // bw, args.rh // bh, args.transpose),
+            args.bits,
+        )
+    else:
+        if not args.quiet and top >= 1 << args.bits:
+            warning("tile indexes don't fit in %d bits" % args.bits)
+        out = pack_rooms(
+            cut_rooms(tile_layer, mw, mh, args.rw, args.rh, args.transpose), args.bits
+        )
 
     # track empty maps
     empty = []
@@ -206,14 +1148,33 @@ def main():
         if all([byte == 0xFF for byte in block]):
             empty.append(i)
 
-    if args.aplib:
-        compressed = []
-        for i, block in enumerate(out):
-            if i in empty:
-                compressed.append(None)
-                continue
-            compressed.append(apultra_compress(block))
-        out = compressed
+    if args.flips:
+        # flag plane after the tiles, a nibble per tile
+        if flags is None:
+            flags = [0] * len(tile_layer)
+        planes = pack_rooms(cut_rooms(flags, mw, mh, args.rw, args.rh, args.transpose), 4)
+        out = [block + plane for block, plane in zip(out, planes)]
+
+    codecs = None
+    if args.compress:
+        out, codecs = compress_codecs(out, empty, args.compress, args, args.budget)
+        if not args.quiet and args.compress == "auto":
+            names = dict((codec.id, name) for name, codec in CODECS.items())
+            used = defaultdict(int)
+            for codec_id in codecs:
+                if codec_id is not None:
+                    used[names[codec_id]] += 1
+            print(
+                "%s: %s codecs: %s"
+                % (
+                    path.basename(sys.argv[0]),
+                    args.id,
+                    ", ".join("%s %d" % item for item in sorted(used.items())),
+                ),
+                file=sys.stderr,
+            )
+    elif args.aplib:
+        out = compress_rooms(out, empty, args.jobs, args.cache)
 
     # add the map header
     for i in range(len(out)):
@@ -222,208 +1183,59 @@ def main():
         size = len(out[i])
 
         # ents size placeholder 0
-        out[i] = [size & 0xFF, size >> 8, 0] + out[i]
-
-    try:
-        entities_layer = find_name(data["layers"], "Entities")
-    except ValueError:
-        entities_layer = []
-        if not args.quiet:
-            print(
-                "%s: warning: 'Entities' layer not found" % path.basename(sys.argv[0]),
-                file=sys.stderr,
-            )
-    if len(entities_layer) and entities_layer["visible"]:
-        with open(args.conf, "rt") as fd:
-            conf = json.load(fd)
-        et_names = [d["name"] for d in conf["entities"]]
-        et_weigths = dict((d["name"], d["w"]) for d in conf["entities"])
-        et_bytes = dict((d["name"], d["bytes"]) for d in conf["entities"])
-        map_ents = defaultdict(list)
-        map_ents_w = defaultdict(int)
-        map_ents_bytes = defaultdict(int)
-        map_ents_names = set()
-
-        def check_bytes(name):
-            if name not in map_ents_names:
-                # update the entity size in bytes count per map
-                try:
-                    map_ents_bytes[m] += et_bytes[name]
-                    map_ents_names.add(name)
-                except KeyError:
-                    parser.error("max_bytes: no 'bytes' found for %r" % name)
-
-        try:
-            objs = entities_layer["objects"]
-            objs.sort(key=lambda o: o["y"])
-            objs.sort(key=lambda o: o["x"])
-            objs.sort(key=lambda o: et_names.index(o["name"].lower()))
-        except ValueError:
-            parser.error("map has an unnamed object")
-
-        for obj in objs:
-            name = obj["name"].lower()
-            m = ((obj["x"] // tilewidth) // args.rw) + (
-                ((obj["y"] // tileheight) // args.rh) * (mw // args.rw)
-            )
-            x = obj["x"] % (args.rw * tilewidth)
-            y = obj["y"] % (args.rh * tileheight)
-
-            t = et_names.index(name)
-
-            # MSB is direction
-
-            param = int(get_property(obj, "param", 0))
-            if param == 1:
-                t |= 128
-
-            if args.max_ents:
-                # update the entity count per map
-                try:
-                    map_ents_w[m] += et_weigths[name]
-                except KeyError:
-                    parser.error("max_ents: no 'w' found for %r" % name)
-
-            if args.max_bytes:
-                check_bytes(name)
-
-            special = None
-
-            # specials
-            if get_property(obj, "fixed", None) is not None:
-                if obj["width"] >= obj["height"]:
-                    special = obj["width"] - tilewidth
-                    if not param:
-                        x += special
-                    special //= tilewidth
-                    # flag horizonal
-                    special |= 128
-                else:
-                    special = obj["height"] - tileheight
-                    if not param:
-                        y += special
-                    special //= tileheight
-
-            map_ents[m].extend([t, x, y])
-            if special is not None:
-                if isinstance(special, (tuple, list)):
-                    map_ents[m].extend(special)
-                else:
-                    map_ents[m].append(special)
-
-        if args.max_ents:
-            for i, weight in map_ents_w.items():
-                if weight > args.max_ents:
-                    parser.error(
-                        "map %i has %d entities, max is %d" % (i, weight, args.max_ents)
-                    )
+        out[i] = [size & 0xFF, size >> 8, 0] + ([codecs[i]] if codecs else []) + out[i]
 
-        if args.max_bytes:
-            for i, byts in map_ents_bytes.items():
-                if byts > args.max_bytes:
-                    parser.error(
-                        "map %i entities are %d bytes, max is %d"
-                        % (i, byts, args.max_bytes)
-                    )
-
-        # append the entities to the map data
-        for i in range(len(out)):
-            if not out[i]:
-                continue
-            elif map_ents[i]:
-                out[i].extend(map_ents[i])
-                out[i][2] += len(map_ents[i])
-            # terminator
-            out[i].append(0xFF)
-            out[i][2] += 1
+    add_entities(out, data, args, mw)
 
     if args.reverse:
         out.reverse()
+        # the writers find empty rooms by their index
+        empty = sorted(len(out) - 1 - i for i in empty)
+
+    duplicates = find_duplicates(out, empty) if args.dedup else None
+
+    if args.archive:
+        write_archive(out, empty, args, mw, duplicates)
+    elif args.bin:
+        write_bin(out, empty, args, duplicates)
+    elif args.format == "c":
+        write_c(out, empty, args, mw, fd, duplicates, metatiles)
+    else:
+        if args.format == "incbin":
+            write_bin(out, empty, args, duplicates)
+        write_asm(out, empty, args, mw, fd, duplicates, args.format == "incbin", metatiles)
+    if metatiles is not None and (args.archive or args.bin or args.format == "incbin"):
+        write_metatiles(metatiles, args)
 
-    if args.bin:
-        for i, block in enumerate(out):
-            filename = path.join(args.dir, "%s%02d.bin" % (args.id, i))
-            remove_list.append(filename)
-            with open(filename, "wb") as fd:
-                if i in empty:
-                    fd.write(struct.pack("<B", 0))
-                else:
-                    fd.write(bytearray(block))
-
-        if not args.quiet:
-            screen_with_data = len(out) - len(empty)
-            total_bytes = sum(len(b) if b else 0 for b in out)
+    if not args.quiet:
+        if metatiles is not None:
             print(
-                "%s: %s (%d screens, %d bytes, %.2f bytes avg)"
+                "%s: %s metatiles: %d (%d bytes)"
                 % (
                     path.basename(sys.argv[0]),
                     args.id,
-                    screen_with_data,
-                    total_bytes,
-                    total_bytes / screen_with_data,
+                    len(metatiles) // (args.metatiles[0] * args.metatiles[1]),
+                    len(metatiles),
                 ),
                 file=sys.stderr,
             )
-        return
+        print_stats(out, empty, args, duplicates)
 
-    print("#ifndef _%s_H" % args.id.upper())
-    print("#define _%s_H" % args.id.upper())
-    print("/* compressed: %s */" % args.aplib)
-    print("#define WMAPS %d\n" % (mw // args.rw))
-    print("#define MAPS %d\n" % len(out))
 
-    print("#ifdef LOCAL")
+def main(argv=None, fd=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
 
-    # includes a map table for fast access
-    data_out = ""
-    for i, block in enumerate(out):
-        if not isinstance(block, list):
-            continue
-        data_out_part = ""
-        for part in range(0, len(block), args.rw // 2):
-            if data_out_part:
-                data_out_part += ",\n"
-            data_out_part += ", ".join(
-                ["0x%02x" % byte for byte in block[part : part + args.rw // 2]]
-            )
-        data_out += "const unsigned char %s_%d[%d] = {\n" % (args.id, i, len(block))
-        data_out += data_out_part + "\n};\n"
-
-    data_out += "const unsigned char * const %s[%d] = { " % (args.id, len(out))
-    data_out += ", ".join(
-        [
-            "%s_%d" % (args.id, i) if i not in empty else "(unsigned char *)0"
-            for i in range(len(out))
-        ]
-    )
-    data_out += " };\n"
-    print(data_out)
-
-    print("#else")
-    print("extern const unsigned char * const %s[%d];\n" % (args.id, len(out)))
+    try:
+        convert(args, fd=fd)
+    except MapError as ex:
+        parser.error(str(ex))
 
-    print("#endif // LOCAL")
-    print("#endif // _%s_H" % args.id.upper())
-
-    if not args.quiet:
-        screen_with_data = len(out) - len(empty)
-        total_bytes = sum(len(b) if b else 0 for b in out)
-        print(
-            "%s: %s (%d screens, %d bytes, %.2f bytes avg)"
-            % (
-                path.basename(sys.argv[0]),
-                args.id,
-                screen_with_data,
-                total_bytes,
-                total_bytes / screen_with_data,
-            ),
-            file=sys.stderr,
-        )
 
+# files to remove if the conversion fails
+remove_list = []
 
 if __name__ == "__main__":
-    remove_list = []
-
     try:
         main()
     except Exception as ex:
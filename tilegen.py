@@ -3,18 +3,35 @@
 import sys
 import os
 import re
+import base64
+import gzip
 import json
 import glob
 import hashlib
 import math
+import mmap
+import operator
 import subprocess
-import pprint
+import pickle
 import re
+import struct
+import tempfile
+import zlib
 from subprocess import DEVNULL, STDOUT, check_call
-from collections import OrderedDict
+from array import array
+from bisect import bisect_right
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import accumulate, islice, repeat
 
 from PIL import Image
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 # debug function
 if os.getenv('DEBUG'):
@@ -23,112 +40,920 @@ else:
     debug = lambda *x: None
 
 
-def main():
-    palette = False
+# Tiled flip flags stored in the upper bits of the gid
+FLIP_H = 0x80000000
+FLIP_V = 0x40000000
+FLIP_D = 0x20000000
 
-    if len(sys.argv) <= 5 or '--help' in sys.argv:
-        sys.exit(f'usage: {sys.argv[0]} ?--has-palette? big_image_files... -- tile_dimensions tilemap_prefix tileset_dimensions')
 
-    if '--has-palette' in sys.argv:
-        palette = True
-        del sys.argv[sys.argv.index('--has-palette')]
-    if '--' in sys.argv:
-        files = sys.argv[1:sys.argv.index('--')]
-        parms = sys.argv[sys.argv.index('--') + 1:]
-    else:
-        files = sys.argv[1:1+1]
-        parms = sys.argv[2:]
+GID_MASK = 0x1FFFFFFF
 
-    if len(files) == 0:
-        sys.exit('No input file specified')
 
-    image_w = image_h = 0
-    for i, file in enumerate(files):
-        if not os.path.exists(file):
-            sys.exit(f'File {file} not found')
-        image = Image.open(file)
-    else:
-        image_w, image_h = image.size
-    debug(f'-- image size: {image_w}x{image_h}')
+# raised by the library functions on bad input, main() exits with it
+class TilegenError(ValueError):
+    pass
 
-    if not (tile_dim := re.search(r'(\d+)x(\d+)', parms[0])):
-        sys.exit('Wrong tile dimensions, <number>x<number> expected')
-    tile_w, tile_h = int(tile_dim.group(1)), int(tile_dim.group(2))
-    if min(tile_w, tile_h) <= 0:
-        sys.exit('Tile dimensions should be greater than zero')
 
-    if not (tileset_dim := re.search(r'(\d+)x(\d+)', parms[2])):
-        sys.exit('Wrong tileset dimensions, <number>x<number> expected')
-    tileset_w, tileset_h = int(tileset_dim.group(1)), int(tileset_dim.group(2))
-    if min(tileset_w, tileset_h) <= 0:
-        sys.exit('Tileset dimensions should be greater than zero')
-    debug(f'-- tileset size: {tileset_w}x{tileset_h}')
+# tile stores bigger than this are moved to a memory-mapped temporary file
+SPILL_LIMIT = 64 * 1024 * 1024
 
-    if not os.path.exists(parms[1]):
-        debug(f'Creating subdirectory {parms[1]}...')
-        os.makedirs(parms[1])
 
-    debug('Cropping tiles from image...')
-    deleted = 0
-    chksums = OrderedDict()
-    tiles = []
-    for path in files:
-        prefix = os.path.join(parms[1], os.path.split(os.path.splitext(path)[0])[1])
-        debug(f'Creating {path} tiles...')
+# raw pixel data of equally sized tiles kept back to back in one buffer,
+# instead of one PIL image per tile; tile size and mode are taken from the
+# first tile stored
+class TileStore:
+    def __init__(self, limit=SPILL_LIMIT):
+        self.limit = limit
+        self.size = None
+        self.mode = None
+        self.palette = None
+        self.tile_bytes = 0
+        self.count = 0
+        self.buffer = bytearray()
+        self.file = None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError('tile index out of range')
+        start = index * self.tile_bytes
+        tile = Image.frombytes(self.mode, self.size, bytes(self.buffer[start:start + self.tile_bytes]))
+        if self.palette is not None:
+            tile.putpalette(self.palette)
+        return tile
+
+    def __iter__(self):
+        return (self[index] for index in range(self.count))
+
+    # grow capacity geometrically, spilling to disk past the size limit
+    def reserve(self, size):
+        if size <= len(self.buffer):
+            return
+        capacity = max(size, 2 * len(self.buffer), 64 * self.tile_bytes)
+        if self.file is None and capacity <= self.limit:
+            self.buffer.extend(bytes(capacity - len(self.buffer)))
+            return
+        if self.file is None:
+            debug(f'Moving {self.count} tiles to a memory-mapped file')
+            self.file = tempfile.TemporaryFile()
+            self.file.write(self.buffer[:self.count * self.tile_bytes])
+        else:
+            self.buffer.close()
+        self.file.truncate(capacity)
+        self.buffer = mmap.mmap(self.file.fileno(), capacity)
+
+    def append(self, tile):
+        if self.size is None:
+            self.size = tile.size
+            self.mode = tile.mode
+            self.palette = tile.getpalette() if tile.mode == "P" else None
+            self.tile_bytes = len(tile.tobytes())
+        elif (tile.size, tile.mode) != (self.size, self.mode):
+            raise ValueError(f'Expected {self.mode} tile of size {self.size}')
+        return self.append_bytes(tile.tobytes())
+
+    # store the raw data of a tile of the size and mode of the store
+    def append_bytes(self, data):
+        start = self.count * self.tile_bytes
+        self.reserve(start + self.tile_bytes)
+        self.buffer[start:start + self.tile_bytes] = data
+        self.count += 1
+        return self.count - 1
+
+    # raw data of all tiles, or of the tiles at indexes in that order
+    def tobytes(self, indexes=None):
+        if indexes is None:
+            return bytes(self.buffer[:self.count * self.tile_bytes])
+        size = self.tile_bytes
+        return b''.join(self.buffer[i * size:(i + 1) * size] for i in indexes)
+
+    # raw data of all tiles without copying it; release the view before
+    # storing more tiles
+    def view(self):
+        return memoryview(self.buffer)[:self.count * self.tile_bytes]
+
+    # new store with a copy of the tiles at indexes, in that order, which
+    # spills to disk past the same limit
+    def subset(self, indexes):
+        store = TileStore(self.limit)
+        store.size, store.mode, store.palette = self.size, self.mode, self.palette
+        store.tile_bytes = size = self.tile_bytes
+        for i in indexes:
+            store.append_bytes(self.buffer[i * size:(i + 1) * size])
+        return store
+
+
+# unique tiles in first-seen order, with constant time checksum to gid lookup
+class TileRegistry:
+    def __init__(self, firstgid=1, limit=SPILL_LIMIT):
+        self.firstgid = firstgid
+        self.gids = {}
+        self.tiles = TileStore(limit)
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def __contains__(self, chksum):
+        return chksum in self.gids
+
+    def __iter__(self):
+        return iter(self.tiles)
+
+    # store tile if not already registered, returning its gid and whether
+    # it's new; a precomputed checksum avoids hashing the tile again
+    def add(self, tile, chksum=None):
+        if chksum is None:
+            chksum = hashlib.md5(tile.tobytes()).hexdigest()
+        if (gid := self.gids.get(chksum)) is not None:
+            return gid, False
+        gid = self.gids[chksum] = self.firstgid + self.tiles.append(tile)
+        return gid, True
+
+    def gid(self, chksum):
+        return self.gids[chksum]
+
+    def tile(self, gid):
+        return self.tiles[gid - self.firstgid]
+
+    # store with the tiles of the given gids, in that order
+    def subset(self, gids):
+        return self.tiles.subset(gid - self.firstgid for gid in gids)
+
+    # make checksum an alias of an already registered tile
+    def alias(self, chksum, gid):
+        self.gids[chksum] = gid
+
+    # renumber tiles to follow the given gid order, returning the mapping
+    # from old to new gids
+    def renumber(self, order):
+        remap = {gid: self.firstgid + i for i, gid in enumerate(order)}
+        self.tiles = self.subset(order)
+        self.gids = {chksum: remap[gid] for chksum, gid in self.gids.items()}
+        return remap
+
+
+# distance between tiles is the number of different pixels
+def tile_signature(tile):
+    data = tile.tobytes()
+    size = len(tile.getbands())
+    return tuple(data[i:i + size] for i in range(0, len(data), size))
+
+
+def tile_distance(sig1, sig2):
+    return sum(map(operator.ne, sig1, sig2))
+
+
+# apply Tiled flip flags to tile: diagonal flip is done first, followed by
+# the horizontal and vertical flips
+def flip_tile(tile, flags):
+    if flags & FLIP_D:
+        tile = tile.transpose(Image.Transpose.TRANSPOSE)
+    if flags & FLIP_H:
+        tile = tile.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    if flags & FLIP_V:
+        tile = tile.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    return tile
+
 
-        image = Image.open(path)
-        # autodetect palette on first line
-        if (image.size[1] - 1) / tile_h == image.size[1] // tile_h:
-            palimg = image.crop((0, 0, 16, 1))
-            image = image.crop((0, 1, image.size[0], image.size[1]))
-            #palimg.save('palette.png')
-            debug('Extracted palette data')
-
-        for y in range(0, image.size[1], tile_h):
-            for x in range(0, image.size[0], tile_w):
-                tile = image.crop((x, y, x + tile_w, y + tile_h)).convert("RGB")
-                chksum = hashlib.md5(tile.tobytes()).hexdigest()
-                if chksum in chksums:
-                    #debug(f'Deleting tile in "{path}", coordinates ({x}, {y}): identical tile already accounted for')
-                    deleted += 1
-                else:
-                    #debug(f'Storing tile {chksum} in "{path}", coordinates ({x}, {y})')
-                    chksums[chksum] = tile
-                if path == files[-1]:
-                    # add tile index to tilemap array
-                    tiles.append(list(chksums.keys()).index(chksum) + 1)
-    debug('%i cropped tiles created.' % len(tiles))
-    debug(f'removed {deleted} files')
-
-    # create tileset
-    real_tileset_h = max(math.ceil(len(chksums) / tile_w), tileset_h) + (1 if palette else 0)
-    result_image = Image.new("RGB", (tileset_w, real_tileset_h))
-
-    if real_tileset_h != tileset_h + (1 if palette else 0):
+def flip_variants(rotate):
+    variants = [0, FLIP_H, FLIP_V, FLIP_H | FLIP_V]
+    if rotate:
+        variants += [flags | FLIP_D for flags in variants]
+    return variants
+
+
+# all flipped/rotated versions of a tile share the key of the smallest one
+def flip_normalize(tile, variants):
+    return hashlib.md5(min(flip_tile(tile, flags).tobytes() for flags in variants)).hexdigest()
+
+
+# find flags that turn the stored tile into tile
+def flip_flags(stored, tile, variants):
+    data = tile.tobytes()
+    for flags in variants:
+        if flip_tile(stored, flags).tobytes() == data:
+            return flags
+    return 0
+
+
+# renumber tile colors in first-appearance order, so color-swapped tiles
+# share the same pattern while each variant keeps its own colors
+def color_normalize(tile):
+    data = tile.tobytes()
+    size = len(tile.getbands())
+    slots = {}
+    pattern = array('H', (slots.setdefault(data[i:i + size], len(slots))
+                          for i in range(0, len(data), size)))
+    # palette indexes for indexed tiles, RGB colors otherwise
+    return pattern, tuple(color[0] if size == 1 else '#' + color.hex() for color in slots)
+
+
+# write per-cell color mapping of color-swapped tiles as a table of unique
+# color lists and one table index per map cell
+def save_colormaps(filename, cell_colors):
+    table = {}
+    data = [table.setdefault(colors, len(table)) for colors in cell_colors]
+    with open(filename, 'w') as fd:
+        json.dump({'colormaps': [list(colors) for colors in table], 'data': data}, fd)
+
+
+# BK-tree for near-identical tile lookups: the triangle inequality prunes
+# most of the tree, so queries don't compare against every stored tile
+class BKTree:
+    def __init__(self, distance):
+        self.distance = distance
+        self.root = None
+
+    def add(self, item, value):
+        node = [item, value, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            dist = self.distance(item, current[0])
+            if (child := current[2].get(dist)) is None:
+                current[2][dist] = node
+                return
+            current = child
+
+    # return (value, distance) of the closest item within threshold or None
+    def find(self, item, threshold):
+        best = None
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            current = stack.pop()
+            dist = self.distance(item, current[0])
+            if dist <= threshold and (best is None or dist < best[1]):
+                best = (current[1], dist)
+            for child_dist, child in current[2].items():
+                if dist - threshold <= child_dist <= dist + threshold:
+                    stack.append(child)
+        return best
+
+
+# open image and strip palette data on the first line, if any
+def load_image(path, tile_h):
+    palimg = None
+    image = Image.open(path)
+    # autodetect palette on first line
+    if (image.size[1] - 1) / tile_h == image.size[1] // tile_h:
+        palimg = image.crop((0, 0, 16, 1))
+        image = image.crop((0, 1, image.size[0], image.size[1]))
+        #palimg.save('palette.png')
+        debug('Extracted palette data')
+    return image, palimg
+
+
+# cut image in tiles, returning the unique tiles of the image in first-seen
+# order and, for every tile in row-major order, the index of its unique
+# tile; tiles are converted to mode, "P" keeps the palette indexes of the
+# source image
+def cut_tiles(image, tile_w, tile_h, mode="RGB"):
+    uniques = OrderedDict()
+    indexes = {}
+    cells = array('I')
+    for y in range(0, image.size[1], tile_h):
+        for x in range(0, image.size[0], tile_w):
+            tile = image.crop((x, y, x + tile_w, y + tile_h)).convert(mode)
+            chksum = hashlib.md5(tile.tobytes()).hexdigest()
+            if chksum not in uniques:
+                indexes[chksum] = len(uniques)
+                uniques[chksum] = tile
+            cells.append(indexes[chksum])
+    return uniques, cells
+
+
+# same as cut_tiles(), but the image is loaded once as an array and split
+# into a (rows, cols, tile_h, tile_w, channels) block view; only unique
+# tiles are hashed and converted back to PIL images.
+def cut_tiles_numpy(image, tile_w, tile_h, mode="RGB"):
+    cols = math.ceil(image.size[0] / tile_w)
+    rows = math.ceil(image.size[1] / tile_h)
+    # crop() pads the image exactly like cropping tile by tile would
+    image = image.crop((0, 0, cols * tile_w, rows * tile_h)).convert(mode)
+    palette = image.getpalette() if mode == "P" else None
+    channels = len(image.getbands())
+    pixels = np.asarray(image, dtype=np.uint8)
+    blocks = pixels.reshape(rows, tile_h, cols, tile_w, channels).swapaxes(1, 2)
+    blocks = np.ascontiguousarray(blocks).reshape(rows * cols, tile_h * tile_w * channels)
+    # view each tile as a single opaque item so np.unique() compares whole tiles
+    keys = blocks.view(np.dtype((np.void, blocks.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    # np.unique() sorts by content: renumber uniques by first appearance
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    uniques = OrderedDict()
+    for index in first[order]:
+        data = blocks[index].tobytes()
+        chksum = hashlib.md5(data).hexdigest()
+        uniques[chksum] = tile = Image.frombytes(mode, (tile_w, tile_h), data)
+        if palette is not None:
+            tile.putpalette(palette)
+    cells = array('I')
+    cells.frombytes(rank[inverse.ravel()].astype(np.uintc).tobytes())
+    return uniques, cells
+
+
+# cached results are keyed by file contents, tile dimensions and mode
+def cache_path(cache_dir, path, tile_w, tile_h, mode="RGB"):
+    # hashed in blocks, so huge images aren't loaded just for their key
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fd:
+        while block := fd.read(65536):
+            md5.update(block)
+    digest = md5.hexdigest()
+    suffix = '' if mode == "RGB" else f'-{mode}'
+    return os.path.join(cache_dir, f'{digest}-{tile_w}x{tile_h}{suffix}.cache')
+
+
+def load_cache(filename, tile_w, tile_h, mode="RGB"):
+    try:
+        with open(filename, 'rb') as fd:
+            raw_tiles, indexes, palimg, palette = pickle.load(fd)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return None
+    uniques = OrderedDict()
+    for chksum, data in raw_tiles:
+        uniques[chksum] = tile = Image.frombytes(mode, (tile_w, tile_h), data)
+        if palette is not None:
+            tile.putpalette(palette)
+    return uniques, array('I', indexes), palimg
+
+
+def save_cache(filename, uniques, cells, palimg):
+    raw_tiles = [(chksum, tile.tobytes()) for chksum, tile in uniques.items()]
+    palette = next(iter(uniques.values())).getpalette() if uniques else None
+    # write to a temporary file first, other workers may read the same entry
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as fd:
+        pickle.dump((raw_tiles, cells, palimg, palette), fd,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, filename)
+
+
+# build a tileset image from a tile store, indexed if tiles are; tile rows
+# are assembled from the raw tile data and pasted at once. Palette data,
+# if any, goes on the first line
+def build_tileset(tiles, tile_w, tile_h, tileset_w, tileset_h, palimg=None):
+    palette = 1 if palimg is not None else 0
+    real_tileset_h = max(math.ceil(len(tiles) / tile_w), tileset_h) + palette
+    if tiles.mode == "P":
+        result_image = Image.new("P", (tileset_w, real_tileset_h))
+        result_image.putpalette(tiles.palette)
+    else:
+        result_image = Image.new("RGB", (tileset_w, real_tileset_h))
+
+    if real_tileset_h != tileset_h + palette:
         debug('Real tileset height differ from the specified parameter')
     if palette:
         # put palette back on resulting image
         result_image.paste(palimg, (0, 0))
+    if len(tiles) == 0:
+        return result_image
 
-    x = y = 0
-    for index, (key, tile) in enumerate(chksums.items()):
-        if (index > 0) and (index % (tileset_w // tile_w) == 0):
-            y += tile_h
-            x = 0
-        #debug('Adding tile %i to output image at (%i, %i)' % (index, x, y))
-        if y + (1 if palette  else 0) >= real_tileset_h:
-            print("WARNING: ** tiles don't fit in specified tileset height **", file=sys.stderr)
-        result_image.paste(tile, (x, y + (1 if palette else 0)))
-        x += tile_w
-
-    # add last arguments to command
-    if palette:
-        # Add "pal" if image has a palete
-        tmp = f'{prefix}-{parms[2]}.pal.png'
+    cols = tileset_w // tile_w
+    rows = math.ceil(len(tiles) / cols)
+    if (rows - 1) * tile_h + palette >= real_tileset_h:
+        lost = len(tiles) - cols * math.ceil((real_tileset_h - palette) / tile_h)
+        print(f"WARNING: ** {lost} tiles don't fit in specified tileset height **", file=sys.stderr)
+
+    # line j of a tile row is line j of every tile in it, side by side; rows
+    # are read from the store one at a time, only the last one is padded
+    line = tiles.tile_bytes // tile_h
+    row_bytes = cols * tiles.tile_bytes
+    with tiles.view() as data:
+        for row in range(min(rows, math.ceil((real_tileset_h - palette) / tile_h))):
+            chunk = data[row * row_bytes:(row + 1) * row_bytes]
+            if len(chunk) < row_bytes:
+                chunk = bytes(chunk) + bytes(row_bytes - len(chunk))
+            lines = (chunk[col * tiles.tile_bytes + j * line:col * tiles.tile_bytes + (j + 1) * line]
+                     for j in range(tile_h) for col in range(cols))
+            strip = Image.frombytes(tiles.mode, (cols * tile_w, tile_h), b''.join(lines))
+            result_image.paste(strip, (0, palette + row * tile_h))
+    return result_image
+
+
+# bank tilesets are marked with their bank number, so map.py knows tile
+# indexes are relative to them
+def tileset_entry(filename, image, count, tile_w, tile_h, firstgid=1, name='default', bank=None):
+    entry = {
+        'columns': math.ceil(image.size[0] / tile_w),
+        'firstgid': firstgid,
+        'image': os.path.split(filename)[1], # remove directory
+        'imagewidth': image.size[0],
+        'imageheight': image.size[1],
+        'margin': 0,
+        'name': name,
+        'spacing': 0,
+        'tilecount': count,
+        'tilewidth': tile_w,
+        'tileheight': tile_h,
+    }
+    if bank is not None:
+        entry['properties'] = [{'name': 'bank', 'type': 'int', 'value': bank}]
+    return entry
+
+
+# regions are bands of tile rows repeated along the height of every map
+# (tilemap data, width), like the three 8-row thirds of an MSX screen 2;
+# every region starts in its own bank and banks sharing most tiles are
+# merged while they fit in the limit. Returns the gids of every bank and
+# the bank of every region (None for regions without tiles)
+def plan_banks(maps, bands, limit=256):
+    regions = [{} for _ in bands]
+    period = sum(bands)
+    region_of_row = [i for i, rows in enumerate(bands) for _ in range(rows)]
+    for tiles, map_w in maps:
+        for index, gid in enumerate(tiles):
+            if gid:
+                row = index // map_w
+                regions[region_of_row[row % period]][gid & GID_MASK] = None
+    for i, region in enumerate(regions):
+        if len(region) > limit:
+            raise TilegenError(f'Region {i} uses {len(region)} tiles, more than {limit}: use smaller bands')
+
+    # (tiles, regions) of every bank
+    banks = [(region, {i}) for i, region in enumerate(regions) if region]
+    while True:
+        best = None
+        for i in range(len(banks)):
+            for j in range(i + 1, len(banks)):
+                shared = len(banks[i][0].keys() & banks[j][0].keys())
+                if shared and len(banks[i][0]) + len(banks[j][0]) - shared <= limit \
+                        and (best is None or shared > best[0]):
+                    best = (shared, i, j)
+        if best is None:
+            break
+        _, i, j = best
+        tiles, merged = banks.pop(j)
+        banks[i][0].update(tiles)
+        banks[i][1].update(merged)
+    debug(f'{sum(len(tiles) for tiles, _ in banks) - len(set().union(*(tiles for tiles, _ in banks)))} tiles repeated across banks')
+    region_banks = [None] * len(bands)
+    for n, (_, merged) in enumerate(banks):
+        for i in merged:
+            region_banks[i] = n
+    return [list(tiles) for tiles, _ in banks], region_banks
+
+
+# place tiles in banks and renumber the data of every map (tilemap data,
+# width) so each cell uses the bank of its region; banks list their tiles
+# in gid order if ordered is set, or in order of appearance otherwise.
+# Returns the gids of every bank, the bank of every region and the maps
+def bank_layout(maps, bands, ordered=False):
+    banks, region_banks = plan_banks(maps, bands)
+    if ordered:
+        for bank in banks:
+            bank.sort()
+
+    remaps = []
+    firstgid = 1
+    for bank in banks:
+        remaps.append({gid: firstgid + i for i, gid in enumerate(bank)})
+        firstgid += len(bank)
+
+    period = sum(bands)
+    row_remap = [remaps[region_banks[i]] if region_banks[i] is not None else None
+                 for i, rows in enumerate(bands) for _ in range(rows)]
+    datas = []
+    for tiles, map_w in maps:
+        datas.append([row_remap[(index // map_w) % period][gid & GID_MASK] | (gid & ~GID_MASK)
+                      if gid else 0 for index, gid in enumerate(tiles)])
+    return banks, region_banks, datas
+
+
+# tile order for the map compressor: the most used tile comes first, then
+# each tile is followed by the unplaced tile most often found to its right,
+# or by the most used one left. Maps are (tilemap data, width)
+def tile_order(registry, maps):
+    counts = Counter()
+    follows = defaultdict(Counter)
+    for tiles, map_w in maps:
+        tiles = [gid & GID_MASK for gid in tiles]
+        counts.update(tiles)
+        for row in range(0, len(tiles), map_w):
+            line = tiles[row:row + map_w]
+            for left, right in zip(line, line[1:]):
+                if left != right:
+                    follows[left][right] += 1
+
+    gids = range(registry.firstgid, registry.firstgid + len(registry))
+    by_count = iter(sorted(gids, key=lambda gid: -counts[gid]))
+    order = []
+    placed = set()
+    current = None
+    while len(order) < len(registry):
+        nexts = [(n, counts[gid], -gid) for gid, n in follows[current].items() if gid not in placed]
+        current = -max(nexts)[2] if nexts else next(gid for gid in by_count if gid not in placed)
+        order.append(current)
+        placed.add(current)
+    return order
+
+
+# tile indexes map.py reads from every map (tilemap data, width) once
+# layout_tilesets() writes it: relative to the tileset of the bank of each
+# cell with banks, -1 for empty cells
+def map_indexes(maps, banks=None, ordered=False):
+    if not banks:
+        return [[(gid & GID_MASK) - 1 for gid in tiles] for tiles, _ in maps]
+    bank_gids, _, datas = bank_layout(maps, banks, ordered)
+    firstgids = list(accumulate((len(bank) for bank in bank_gids[:-1]), initial=1))
+    return [[(gid & GID_MASK) - firstgids[bisect_right(firstgids, gid & GID_MASK) - 1] if gid else -1
+             for gid in tiles] for tiles in datas]
+
+
+# estimated size of tile indexes stored as the difference to the tile on
+# their left (the index itself at the start of a row), compressed with
+# deflate over the whole map. Renumbering tiles only relabels them, so it
+# doesn't change the runs and matches found by map.py's RLE, LZ and aPLib
+# codecs: only formats storing differences between indexes can benefit
+def delta_size(indexes, map_w):
+    return len(zlib.compress(bytes((index - (indexes[i - 1] if i % map_w else 0)) & 0xFF
+                                   for i, index in enumerate(indexes)), 9))
+
+
+# PNG (bit depth, color type) supported by the streaming reader: mode,
+# raw mode and bytes per pixel
+PNG_MODES = {
+    (1, 0): ('1', '1', 1),
+    (2, 0): ('L', 'L;2', 1),
+    (4, 0): ('L', 'L;4', 1),
+    (8, 0): ('L', 'L', 1),
+    (8, 2): ('RGB', 'RGB', 3),
+    (1, 3): ('P', 'P;1', 1),
+    (2, 3): ('P', 'P;2', 1),
+    (4, 3): ('P', 'P;4', 1),
+    (8, 3): ('P', 'P', 1),
+    (8, 4): ('LA', 'LA', 2),
+    (8, 6): ('RGBA', 'RGBA', 4),
+}
+
+
+# reverse PNG scanline filter
+def png_unfilter(ftype, line, prev, bpp):
+    if ftype == 0:
+        return line
+    cur = bytearray(line)
+    if ftype == 1:
+        for i in range(bpp, len(cur)):
+            cur[i] = (cur[i] + cur[i - bpp]) & 0xff
+    elif ftype == 2:
+        cur = bytearray((a + b) & 0xff for a, b in zip(cur, prev))
+    elif ftype == 3:
+        for i in range(len(cur)):
+            left = cur[i - bpp] if i >= bpp else 0
+            cur[i] = (cur[i] + ((left + prev[i]) >> 1)) & 0xff
+    elif ftype == 4:
+        for i in range(len(cur)):
+            a = cur[i - bpp] if i >= bpp else 0
+            b = prev[i]
+            c = prev[i - bpp] if i >= bpp else 0
+            p = a + b - c
+            pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+            cur[i] = (cur[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xff
     else:
-        tmp = f'{prefix}-{parms[2]}.png'
-    result_image.save(tmp)
+        raise ValueError(f'Invalid PNG filter type {ftype}')
+    return bytes(cur)
+
+
+# decode a PNG one scanline at a time: the first item is the image header
+# (width, height, mode, raw mode, palette), then every decoded line follows.
+# Compressed data is read and inflated a few lines at a time, so memory
+# doesn't depend on the size of the IDAT chunks. Interlaced and 16-bit
+# images are not supported and raise ValueError.
+def png_rows(path, lines=16, block=65536):
+    with open(path, 'rb') as fd:
+        if fd.read(8) != b'\x89PNG\r\n\x1a\n':
+            raise ValueError(f'{path} is not a PNG file')
+        palette = None
+        inflate = zlib.decompressobj()
+        pending = bytearray()
+        started = False
+        while len(chunk := fd.read(8)) == 8:
+            length, ctype = struct.unpack('>I4s', chunk)
+            if ctype != b'IDAT':
+                data = fd.read(length)
+                fd.read(4) # CRC
+            if ctype == b'IHDR':
+                width, height, depth, color, _, _, interlace = struct.unpack('>IIBBBBB', data)
+                if interlace or (depth, color) not in PNG_MODES:
+                    raise ValueError(f'{path}: interlaced or 16-bit PNG files cannot be streamed')
+                mode, rawmode, bpp = PNG_MODES[depth, color]
+                stride = math.ceil(width * depth / 8) * bpp
+                prev = bytes(stride)
+                limit = lines * (stride + 1)
+            elif ctype == b'PLTE':
+                palette = data
+            elif ctype == b'IDAT':
+                if not started:
+                    yield width, height, mode, rawmode, palette
+                    started = True
+                while length:
+                    data = fd.read(min(length, block))
+                    length -= len(data)
+                    # inflate no more than limit bytes at a time, the rest of
+                    # the input is kept in unconsumed_tail
+                    while True:
+                        out = inflate.decompress(data, limit)
+                        pending += out
+                        full = len(pending) // (stride + 1) * (stride + 1)
+                        for offset in range(0, full, stride + 1):
+                            prev = png_unfilter(pending[offset],
+                                bytes(pending[offset + 1:offset + stride + 1]), prev, bpp)
+                            yield prev
+                        del pending[:full]
+                        data = inflate.unconsumed_tail
+                        if not data and len(out) < limit:
+                            break
+                fd.read(4) # CRC
+            elif ctype == b'IEND':
+                break
+
+
+# cut image decoding only a band of tile_h lines at a time, so memory
+# depends on the image width instead of its area
+def cut_tiles_streaming(path, tile_w, tile_h, cut=cut_tiles, mode="RGB"):
+    rows = png_rows(path)
+    width, height, png_mode, rawmode, palette = next(rows)
+
+    def band(lines):
+        image = Image.frombytes(png_mode, (width, len(lines)), b''.join(lines), 'raw', rawmode)
+        if palette is not None:
+            image.putpalette(palette)
+        return image
+
+    palimg = None
+    # autodetect palette on first line
+    if (height - 1) / tile_h == height // tile_h:
+        palimg = band([next(rows)]).crop((0, 0, 16, 1))
+        height -= 1
+        debug('Extracted palette data')
+
+    uniques = OrderedDict()
+    indexes = {}
+    cells = array('I')
+    for y in range(0, height, tile_h):
+        band_uniques, band_cells = cut(band(list(islice(rows, min(tile_h, height - y)))), tile_w, tile_h, mode)
+        for chksum, tile in band_uniques.items():
+            if chksum not in uniques:
+                indexes[chksum] = len(uniques)
+                uniques[chksum] = tile
+        # band indexes to image indexes
+        remap = [indexes[chksum] for chksum in band_uniques]
+        cells.extend(remap[i] for i in band_cells)
+    rows.close()
+    return uniques, cells, palimg
+
+
+# store layer data as Tiled's base64 encoding, optionally compressed
+def encode_layer(layer, compression):
+    data = array('I', layer['data'])
+    if sys.byteorder != 'little':
+        data.byteswap()
+    data = data.tobytes()
+    if compression == 'zlib':
+        data = zlib.compress(data, 9)
+    elif compression == 'gzip':
+        data = gzip.compress(data, 9)
+    layer['encoding'] = 'base64'
+    layer['compression'] = compression if compression != 'none' else ''
+    layer['data'] = base64.b64encode(data).decode('ascii')
+
+
+# write map as JSON, keeping plain layer data on a single line
+def save_map(filename, tiled):
+    layers = [layer for layer in tiled['layers'] if isinstance(layer.get('data'), list)]
+    datas = [layer['data'] for layer in layers]
+    for index, layer in enumerate(layers):
+        layer['data'] = f'@data{index}@'
+    text = json.dumps(tiled, indent=4, sort_keys=True)
+    for index, (layer, data) in enumerate(zip(layers, datas)):
+        layer['data'] = data
+        text = text.replace(f'"@data{index}@"', json.dumps(data, separators=(',', ':')))
+    with open(filename, 'w') as fd:
+        fd.write(text)
+
+
+# cut results shared between jobs run in the same process (see batch.py),
+# disabled when None
+shared_tiles = None
+
+
+# load and cut a single image, possibly in a worker process
+def process_file(path, tile_w, tile_h, use_numpy, cache_dir=None, stream=False, mode="RGB"):
+    if cache_dir:
+        filename = cache_path(cache_dir, path, tile_w, tile_h, mode)
+        if (cached := load_cache(filename, tile_w, tile_h, mode)) is not None:
+            debug(f'Using cached tiles for {path}')
+            return cached
 
+    cut = cut_tiles_numpy if use_numpy else cut_tiles
+    try:
+        if not stream:
+            raise ValueError('streaming disabled')
+        uniques, cells, palimg = cut_tiles_streaming(path, tile_w, tile_h, cut, mode)
+    except ValueError as ex:
+        if stream:
+            debug(f'{ex}, decoding whole image')
+        image, palimg = load_image(path, tile_h)
+        uniques, cells = cut(image, tile_w, tile_h, mode)
+
+    if cache_dir:
+        save_cache(filename, uniques, cells, palimg)
+    return uniques, cells, palimg
+
+
+# cut every image, in parallel when jobs > 1, yielding (path, result) in
+# input order so gids are the same as in a serial run
+def cut_images(files, tile_w, tile_h, jobs=1, use_numpy=False, cache_dir=None, stream=False,
+               mode="RGB"):
+    keys = [(os.path.abspath(path), os.path.getmtime(path), tile_w, tile_h, mode) for path in files]
+    todo = [path for path, key in zip(files, keys)
+            if shared_tiles is None or key not in shared_tiles]
+    with ProcessPoolExecutor(jobs) if jobs > 1 and len(todo) > 1 else nullcontext() as pool:
+        results = (pool.map if pool else map)(process_file, todo,
+            repeat(tile_w), repeat(tile_h), repeat(use_numpy), repeat(cache_dir),
+            repeat(stream), repeat(mode))
+        for path, key in zip(files, keys):
+            if shared_tiles is not None and key in shared_tiles:
+                yield path, shared_tiles[key]
+                continue
+            result = next(results)
+            if shared_tiles is not None:
+                shared_tiles[key] = result
+            yield path, result
+
+
+# merge the unique tiles of every image into a single registry
+class TileDedup:
+    def __init__(self, tile_w, tile_h, near=0, color_swap=False, variants=None):
+        self.tile_w = tile_w
+        self.tile_h = tile_h
+        self.near = near
+        self.color_swap = color_swap
+        # flip/rotate variants, None if disabled
+        self.variants = variants
+        self.registry = TileRegistry()
+        self.similar = BKTree(tile_distance)
+        self.colormaps = {}
+        self.flags = {}
+        self.deleted = 0
+
+    def add(self, path, uniques, cells):
+        chksums = self.registry
+        flip = self.variants is not None
+        self.deleted += len(cells)
+        if self.near:
+            cols = math.ceil(Image.open(path).size[0] / self.tile_w)
+            positions = {}
+            for i, index in enumerate(cells):
+                positions.setdefault(index, i)
+        for index, (chksum, tile) in enumerate(uniques.items()):
+            key = sig = chksum
+            if self.color_swap:
+                # color-swapped variants share the same pattern key
+                pattern, self.colormaps[chksum] = color_normalize(tile)
+                key = hashlib.md5(pattern.tobytes()).hexdigest()
+                sig = tuple(pattern)
+            elif flip:
+                # flipped variants share the same key
+                key = flip_normalize(tile, self.variants)
+            if key in chksums:
+                gid = chksums.gid(key)
+                chksums.alias(chksum, gid)
+                if flip:
+                    self.flags[chksum] = flip_flags(chksums.tile(gid), tile, self.variants)
+                continue
+            if self.near:
+                if not self.color_swap:
+                    sig = tile_signature(tile)
+                if (found := self.similar.find(sig, self.near)) is not None:
+                    gid, dist = found
+                    chksums.alias(key, gid)
+                    chksums.alias(chksum, gid)
+                    y, x = divmod(positions[index], cols)
+                    print(f'{path}: tile at ({x * self.tile_w}, {y * self.tile_h}) merged into tile {gid} (distance {dist})', file=sys.stderr)
+                    continue
+            #debug(f'Storing tile {chksum} from "{path}"')
+            gid = chksums.add(tile, key)[0]
+            chksums.alias(chksum, gid)
+            if self.near:
+                self.similar.add(sig, gid)
+            self.deleted -= 1
+
+    # tilemap data for the cells of an image
+    def gids(self, uniques, cells):
+        gids = [self.registry.gid(chksum) | self.flags.get(chksum, 0) for chksum in uniques]
+        return [gids[index] for index in cells]
+
+    def colors(self, uniques, cells):
+        colormaps = [self.colormaps[chksum] for chksum in uniques]
+        return [colormaps[index] for index in cells]
+
+
+# TMS9918 colors, used to match RGB tiles to MSX1 color indexes
+TMS9918_PALETTE = [
+    (0, 0, 0), (0, 0, 0), (33, 200, 66), (94, 220, 120),
+    (84, 85, 237), (125, 118, 252), (212, 82, 77), (66, 235, 245),
+    (252, 85, 84), (255, 121, 120), (212, 193, 84), (230, 206, 128),
+    (33, 176, 59), (201, 91, 186), (204, 204, 204), (255, 255, 255),
+]
+
+
+# convert a store of 8x8 tiles to TMS9918 screen 2 pattern and color
+# tables; indexed tiles use their palette indexes, RGB tiles the nearest
+# MSX1 color
+def vram_tables(tiles):
+    shape = (len(tiles), 8, 8) + ((3,) if tiles.mode == "RGB" else ())
+    pixels = np.frombuffer(tiles.tobytes(), dtype=np.uint8).reshape(shape).astype(np.int32)
+    if pixels.ndim == 4:
+        palette = np.array(TMS9918_PALETTE[1:], dtype=np.int32)
+        pixels = ((pixels[..., None, :] - palette) ** 2).sum(-1).argmin(-1) + 1
+    elif pixels.max() > 15:
+        raise TilegenError('Indexed tiles should only use palette indexes 0 to 15')
+
+    # every 8x1 line is a pattern byte with foreground and background colors
+    lines = pixels.reshape(-1, 8)
+    fg = lines.max(axis=1)
+    bg = lines.min(axis=1)
+    valid = ((lines == fg[:, None]) | (lines == bg[:, None])).all(axis=1)
+    if not valid.all():
+        wrong = np.flatnonzero(~valid)
+        for line in wrong[:10]:
+            print(f'tile {line // 8}, line {line % 8}: more than 2 colors', file=sys.stderr)
+        raise TilegenError(f'{len(wrong)} tile lines have more than 2 colors')
+    patterns = np.packbits((lines == fg[:, None]) & (fg != bg)[:, None], axis=1)
+    colors = (fg << 4) | bg
+    return patterns.astype(np.uint8).tobytes(), colors.astype(np.uint8).tobytes()
+
+
+# write pattern and color tables ready to be copied to VRAM
+def save_vram_tables(name, tiles):
+    patterns, colors = vram_tables(tiles) if len(tiles) else (b'', b'')
+    with open(f'{name}.chr', 'wb') as fd:
+        fd.write(patterns)
+    with open(f'{name}.clr', 'wb') as fd:
+        fd.write(colors)
+
+
+# write the tilemap as a name table, with tile indexes relative to the
+# tileset (bank) of each tile
+def save_name_table(filename, tilesets, tiles):
+    firstgids = [tileset['firstgid'] for tileset in tilesets]
+    data = bytearray()
+    for gid in tiles:
+        if gid & ~GID_MASK:
+            raise TilegenError('Name tables cannot use flipped tiles')
+        index = gid - max(first for first in firstgids if first <= gid)
+        if index > 255:
+            raise TilegenError('Name tables require less than 256 tiles per bank, use --banks')
+        data.append(index)
+    with open(filename, 'wb') as fd:
+        fd.write(data)
+
+
+# save tileset images, one per bank if banks are specified, returning the
+# tileset entries, the data of every map (tilemap data, width) renumbered
+# to match and the bank of every region (None without banks)
+def layout_tilesets(registry, maps, name, tile_size, tileset_size,
+                    palimg=None, banks=None, vram=False, ordered=False):
+    tile_w, tile_h = tile_size
+    tileset_w, tileset_h = tileset_size
+    suffix = '.pal' if palimg is not None else ''
+    if not banks:
+        filename = f'{name}{suffix}.png'
+        result_image = build_tileset(registry.tiles, tile_w, tile_h, tileset_w, tileset_h, palimg)
+        result_image.save(filename)
+        if vram:
+            save_vram_tables(name, registry.tiles)
+        return [tileset_entry(filename, result_image, len(registry), tile_w, tile_h)], \
+            [tiles for tiles, _ in maps], None
+
+    bank_gids, region_banks, datas = bank_layout(maps, banks, ordered)
+    tilesets = []
+    firstgid = 1
+    for n, bank in enumerate(bank_gids):
+        filename = f'{name}.bank{n}{suffix}.png'
+        tiles = registry.subset(bank)
+        result_image = build_tileset(tiles, tile_w, tile_h, tileset_w, tileset_h, palimg)
+        result_image.save(filename)
+        if vram:
+            save_vram_tables(f'{name}.bank{n}', tiles)
+        tilesets.append(tileset_entry(filename, result_image, len(bank), tile_w, tile_h,
+            firstgid, 'default' if n == 0 else f'bank{n}', n))
+        firstgid += len(bank)
+        debug(f'bank {n}: {len(bank)} tiles')
+    return tilesets, datas, region_banks
+
+
+# region_banks, if any, is saved as the "banks" property: the bank of every
+# region, -1 for regions without tiles
+def tiled_map(map_w, map_h, tile_w, tile_h, tilesets, tiles, region_banks=None):
     tiled = {
         'compression_level': -1,
         'editorsettings':
@@ -140,8 +965,8 @@ def main():
             },
         'nextlayerid': 2,
         'nextobjectid': 0,
-        'width': math.ceil(image_w / tile_w),
-        'height': math.ceil(image_h / tile_h),
+        'width': map_w,
+        'height': map_h,
         'infinite': False,
         'tilewidth': tile_w,
         'tileheight': tile_h,
@@ -150,30 +975,15 @@ def main():
         'tiledversion': '1.3.1',
         'type': 'map',
         'version': 1.2,
-        'tilesets':
-            [
-                {
-                    'columns': math.ceil(tileset_w / tile_w),
-                    'firstgid': 1,
-                    'image': os.path.split(tmp)[1], # remove directory
-                    'imagewidth': tileset_w,
-                    'imageheight': real_tileset_h,
-                    'margin': 0,
-                    'name': 'default',
-                    'spacing': 0,
-                    'tilecount': len(chksums),
-                    'tilewidth': tile_w,
-                    'tileheight': tile_h,
-                },
-            ],
+        'tilesets': tilesets,
         'layers':
             [
                 {
                     'id': 1,
                     'name': 'Map',
                     'opacity': 1,
-                    'width': math.ceil(image_w / tile_w),
-                    'height': math.ceil(image_h / tile_h),
+                    'width': map_w,
+                    'height': map_h,
                     'type': 'tilelayer',
                     'visible': True,
                     'x': 0,
@@ -182,14 +992,222 @@ def main():
                 }
             ],
     }
-    with open(f'{prefix}.json', 'w') as jsonmap:
-        # convert pretty print output into proper json for Tiled
-        json = pprint.pformat(tiled, indent=4, width=80, compact=True)
-        json = re.sub(r': True\b', ': true', json, count=0, flags=0)
-        json = re.sub(r': False\b', ': false', json, count=0, flags=0)
-        jsonmap.write(json.replace("'", '"'))
+    if region_banks is not None:
+        tiled['properties'] = [{
+            'name': 'banks',
+            'type': 'string',
+            'value': ','.join(str(-1 if n is None else n) for n in region_banks),
+        }]
+    return tiled
+
+
+# create tileset and tilemap from files; the tilemap is created from the
+# last file, or from every file if all_maps is set, and everything is
+# saved in output_dir. Returns the created maps.
+def tilegen(files, tile_size, output_dir, tileset_size, palette=False, jobs=1,
+            use_numpy=False, cache_dir=None, near=0, color_swap=False, flip=False,
+            rotate=False, banks=None, stream=False, compression=None, indexed=False,
+            vram=False, vram_names=False, all_maps=False, reorder=False):
+    tile_w, tile_h = tile_size
+    tileset_w, tileset_h = tileset_size
+
+    if len(files) == 0:
+        raise TilegenError('No input file specified')
+    if use_numpy and np is None:
+        raise TilegenError('--numpy requires the numpy module')
+    if flip and color_swap:
+        raise TilegenError('Options --flip and --rotate cannot be used with --color-swap')
+    if rotate and tile_w != tile_h:
+        raise TilegenError('Option --rotate requires square tiles')
+    if compression not in (None, 'none', 'zlib', 'gzip'):
+        raise TilegenError('Wrong layer compression, none, zlib or gzip expected')
+    if vram or vram_names:
+        if np is None:
+            raise TilegenError('--vram requires the numpy module')
+        if tile_size != (8, 8):
+            raise TilegenError('--vram requires 8x8 tiles')
+    if min(tile_w, tile_h) <= 0:
+        raise TilegenError('Tile dimensions should be greater than zero')
+    if min(tileset_w, tileset_h) <= 0:
+        raise TilegenError('Tileset dimensions should be greater than zero')
+    debug(f'-- tileset size: {tileset_w}x{tileset_h}')
+
+    # bank regions in tile rows
+    if banks == 'thirds':
+        if 64 % tile_h:
+            raise TilegenError('Screen thirds require tile height to divide 64')
+        banks = [64 // tile_h] * 3
+
+    image_w = image_h = 0
+    for i, file in enumerate(files):
+        if not os.path.exists(file):
+            raise TilegenError(f'File {file} not found')
+        image = Image.open(file)
+        if indexed:
+            # palette indexes are only meaningful if all images share a palette
+            if image.mode != 'P':
+                raise TilegenError(f'File {file} is not an indexed color image')
+            if i == 0:
+                source_palette = image.getpalette()
+            elif image.getpalette() != source_palette:
+                raise TilegenError(f'File {file} palette differs from {files[0]}')
+    else:
+        image_w, image_h = image.size
+    debug(f'-- image size: {image_w}x{image_h}')
+
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    if not os.path.exists(output_dir):
+        debug(f'Creating subdirectory {output_dir}...')
+        os.makedirs(output_dir)
+
+    debug('Cropping tiles from image...')
+    dedup = TileDedup(tile_w, tile_h, near, color_swap,
+                      flip_variants(rotate) if flip or rotate else None)
+    # (prefix, width, tilemap data, cell colors) of every map to create
+    maps = []
+    for path, (uniques, cells, pal) in cut_images(files, tile_w, tile_h, jobs, use_numpy,
+                                                 cache_dir, stream, 'P' if indexed else 'RGB'):
+        prefix = os.path.join(output_dir, os.path.split(os.path.splitext(path)[0])[1])
+        debug(f'Creating {path} tiles...')
+        if pal is not None:
+            palimg = pal
+        dedup.add(path, uniques, cells)
+        if all_maps or path == files[-1]:
+            # gids don't change once assigned, so the tilemap can be
+            # recorded before the whole tileset is known
+            maps.append((prefix, math.ceil(Image.open(path).size[0] / tile_w),
+                         dedup.gids(uniques, cells), dedup.colors(uniques, cells) if color_swap else None))
+    debug('%i cropped tiles created.' % len(maps[-1][2]))
+    debug(f'removed {dedup.deleted} files')
+
+    if reorder:
+        # the order is shared by every map, so it's kept only if it makes
+        # the delta-coded maps smaller as a whole
+        cells = [(tiles, map_w) for _, map_w, tiles, _ in maps]
+        order = tile_order(dedup.registry, cells)
+        remap = {gid: dedup.registry.firstgid + i for i, gid in enumerate(order)}
+        reordered = [[remap[gid & GID_MASK] | (gid & ~GID_MASK) if gid else 0 for gid in tiles]
+                     for tiles, _ in cells]
+        before = [delta_size(indexes, map_w)
+                  for indexes, (_, map_w) in zip(map_indexes(cells, banks), cells)]
+        after = [delta_size(indexes, map_w) for indexes, (_, map_w) in
+                 zip(map_indexes([(tiles, map_w) for tiles, (_, map_w) in zip(reordered, cells)], banks, True), cells)]
+        for (name, _, _, _), size, new_size in zip(maps, before, after):
+            print(f'{name}.json: estimated delta-coded map data {size} -> {new_size} bytes'
+                  ' (whole map; map.py codecs are not affected)', file=sys.stderr)
+        if sum(after) < sum(before):
+            dedup.registry.renumber(order)
+            maps = [(prefix, map_w, tiles, cell_colors)
+                    for (prefix, map_w, _, cell_colors), tiles in zip(maps, reordered)]
+        else:
+            print('reordered tiles are not smaller, keeping the order of appearance', file=sys.stderr)
+            reorder = False
+
+    tilesets, datas, region_banks = layout_tilesets(dedup.registry, [(tiles, map_w) for _, map_w, tiles, _ in maps],
+        f'{prefix}-{tileset_w}x{tileset_h}', tile_size, tileset_size,
+        palimg if palette else None, banks, vram, reorder)
+
+    result = []
+    for (prefix, map_w, _, cell_colors), tiles in zip(maps, datas):
+        if vram_names:
+            save_name_table(f'{prefix}.nam', tilesets, tiles)
+        tiled = tiled_map(map_w, len(tiles) // map_w, tile_w, tile_h, tilesets, tiles, region_banks)
+        if compression:
+            encode_layer(tiled['layers'][0], compression)
+        save_map(f'{prefix}.json', tiled)
+        if color_swap:
+            save_colormaps(f'{prefix}_colors.json', cell_colors)
+        result.append(tiled)
+    return result
+
+
+# remove option and its value from the command line
+def pop_option(argv, name, default=None):
+    if name not in argv:
+        return default
+    index = argv.index(name)
+    if index + 1 >= len(argv):
+        sys.exit(f'Option {name} requires a value')
+    value = argv[index + 1]
+    del argv[index:index + 2]
+    return value
+
+
+# remove flag from the command line, returning whether it was present
+def pop_flag(argv, name):
+    if name not in argv:
+        return False
+    del argv[argv.index(name)]
+    return True
+
+
+# command line arguments as (files, tile size, output directory, tileset
+# size, options of tilegen())
+def parse_args(argv=None):
+    argv = list(sys.argv if argv is None else argv)
+
+    usage = f'usage: {argv[0]} ?--has-palette? ?--numpy? ?--jobs N? ?--cache DIR? ?--near-threshold N? ?--color-swap? ?--flip|--rotate? ?--banks thirds|ROWS,...? ?--stream? ?--compression none|zlib|gzip? ?--indexed? ?--vram? ?--vram-names? ?--all-maps? ?--reorder? big_image_files... -- tile_dimensions tilemap_prefix tileset_dimensions'
+    if len(argv) <= 5 or '--help' in argv:
+        sys.exit(usage)
+
+    options = {
+        'palette': pop_flag(argv, '--has-palette'),
+        'use_numpy': pop_flag(argv, '--numpy'),
+        'cache_dir': pop_option(argv, '--cache'),
+        'color_swap': pop_flag(argv, '--color-swap'),
+        'rotate': pop_flag(argv, '--rotate'),
+        'flip': pop_flag(argv, '--flip'),
+        'banks': pop_option(argv, '--banks'),
+        'compression': pop_option(argv, '--compression'),
+        'stream': pop_flag(argv, '--stream'),
+        'indexed': pop_flag(argv, '--indexed'),
+        'vram': pop_flag(argv, '--vram'),
+        'vram_names': pop_flag(argv, '--vram-names'),
+        'all_maps': pop_flag(argv, '--all-maps'),
+        'reorder': pop_flag(argv, '--reorder'),
+    }
+    jobs = pop_option(argv, '--jobs', '1')
+    if not jobs.isdigit() or int(jobs) <= 0:
+        sys.exit('Number of jobs should be greater than zero')
+    options['jobs'] = int(jobs)
+    near = pop_option(argv, '--near-threshold', '0')
+    if not near.isdigit():
+        sys.exit('Near-identical threshold should be a number of pixels')
+    options['near'] = int(near)
+    if (banks := options['banks']) and banks != 'thirds':
+        if not re.fullmatch(r'\d+(,\d+)*', banks) or 0 in (banks := [int(rows) for rows in banks.split(',')]):
+            sys.exit('Wrong bank regions, "thirds" or <rows>,<rows>,... expected')
+        options['banks'] = banks
+
+    if '--' in argv:
+        files = argv[1:argv.index('--')]
+        parms = argv[argv.index('--') + 1:]
+    else:
+        files = argv[1:1+1]
+        parms = argv[2:]
+    # options are gone, the dimensions and prefix must be left
+    if not files or len(parms) < 3:
+        sys.exit(usage)
+
+    if not (tile_dim := re.search(r'(\d+)x(\d+)', parms[0])):
+        sys.exit('Wrong tile dimensions, <number>x<number> expected')
+    tile_size = int(tile_dim.group(1)), int(tile_dim.group(2))
+
+    if not (tileset_dim := re.search(r'(\d+)x(\d+)', parms[2])):
+        sys.exit('Wrong tileset dimensions, <number>x<number> expected')
+    tileset_size = int(tileset_dim.group(1)), int(tileset_dim.group(2))
+
+    return files, tile_size, parms[1], tileset_size, options
+
+
+def main(argv=None):
+    files, tile_size, output_dir, tileset_size, options = parse_args(argv)
+    try:
+        tilegen(files, tile_size, output_dir, tileset_size, **options)
+    except TilegenError as ex:
+        sys.exit(str(ex))
 
 
 if __name__ == '__main__':
     main()
-